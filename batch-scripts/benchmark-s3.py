@@ -0,0 +1,360 @@
+#!/usr/bin/env python2.5
+# -*- coding: utf-8 -*-
+from mediacore.lib.commands import LoadAppCommand, load_app
+
+_script_name = "S3 request benchmark script"
+_script_description = """Runs every S3 thumbnail hook and AmazonS3Storage method against a local S3 stand-in, such as `moto_server s3 -p 5000`, and reports the wall time, the number of S3 requests by verb and the bytes transferred for each. Request counts can be saved and compared against on later runs to catch regressions."""
+DEBUG = False
+
+if __name__ == "__main__":
+    cmd = LoadAppCommand(_script_name, _script_description)
+    cmd.parser.add_option(
+        '--debug',
+        action='store_true',
+        dest='debug',
+        help='Write debug output to STDOUT.',
+        default=False
+    )
+    cmd.parser.add_option(
+        '--host',
+        dest='host',
+        help='Host of the S3 stand-in.',
+        default='localhost'
+    )
+    cmd.parser.add_option(
+        '--port',
+        type='int',
+        dest='port',
+        help='Port of the S3 stand-in.',
+        default=5000
+    )
+    cmd.parser.add_option(
+        '--bucket',
+        dest='bucket',
+        help='Bucket to create and run against.',
+        default='mediacore-benchmark'
+    )
+    cmd.parser.add_option(
+        '--items',
+        type='int',
+        dest='items',
+        help='Number of items on the simulated listing page.',
+        default=50
+    )
+    cmd.parser.add_option(
+        '--stream-mb',
+        type='int',
+        dest='stream_mb',
+        help='Size of the file streamed by upload_stream, in MB.',
+        default=12
+    )
+    cmd.parser.add_option(
+        '--save',
+        dest='save',
+        help='Save the request counts to this JSON file.',
+        default=None
+    )
+    cmd.parser.add_option(
+        '--baseline',
+        dest='baseline',
+        help='Compare the request counts to those saved in this JSON file '
+             'and exit with an error if any operation makes more requests.',
+        default=None
+    )
+    load_app(cmd)
+    DEBUG = cmd.options.debug
+
+# BEGIN SCRIPT & SCRIPT SPECIFIC IMPORTS
+import os
+import shutil
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+
+import simplejson
+from boto.s3.connection import OrdinaryCallingFormat
+from PIL import Image
+from pylons import config
+
+from mediacore_aws import (get_s3_key_cache, local_thumb_file,
+    s3_create_default_thumbs_for, s3_create_thumbs_for, s3_delete_many,
+    s3_delete_thumbs, s3_has_default_thumbs, s3_prefetch_thumbs,
+    s3_thumb_key, s3_thumb_path, s3_thumb_url)
+from mediacore_aws.lib.connections import get_connection_pool
+from mediacore_aws.lib.engines import s3_engine_cache
+from mediacore_aws.lib.metrics import metrics
+from mediacore_aws.lib.multipart import open_upload
+from mediacore_aws.lib.storage import AmazonS3Storage
+
+VERBS = ('HEAD', 'GET', 'PUT', 'POST', 'DELETE', 'ACL')
+
+class BenchItem(object):
+    """Just enough of a Media item for the thumbnail hooks."""
+    _thumb_dir = 'media'
+
+    def __init__(self, id):
+        self.id = id
+        self.slug = u'benchmark-%d' % id
+        self.files = []
+
+
+class BenchMediaFile(object):
+    """Just enough of a MediaFile for the storage engine."""
+    type = u'video'
+    container = u'mp4'
+    mimetype = 'video/mp4'
+    display_name = u'benchmark.mp4'
+
+    def __init__(self, id, media, storage):
+        self.id = id
+        self.media = media
+        self.storage = storage
+        self.storage_id = storage.id
+        self.unique_id = u'benchmark-%d.mp4' % id
+
+
+def make_image():
+    buf = StringIO()
+    Image.new('RGB', (1600, 1200), (90, 120, 150)).save(buf, 'JPEG')
+    buf.seek(0)
+    return buf
+
+def make_chunks(megabytes):
+    chunk = 'x' * 1048576
+    for i in xrange(megabytes):
+        yield chunk
+
+def setup_cache_dir():
+    """Point ``cache.dir`` at a new temporary dir and return its path.
+
+    The benchmark's made-up items share their IDs with real ones, so the
+    thumbs and local state it writes must never land in the real cache
+    dir. Only the 'new' default thumbs are copied over.
+    """
+    new_thumbs = [s3_thumb_key(image_dir, 'new', size)
+                  for image_dir, sizes in config['thumb_sizes'].iteritems()
+                  for size in sizes]
+    sources = [local_thumb_file(path) for path in new_thumbs]
+    cache_dir = tempfile.mkdtemp(prefix='mediacore-benchmark-')
+    config['cache.dir'] = cache_dir
+    config['s3.local_cache_dir'] = ''
+    for path, src_file in zip(new_thumbs, sources):
+        dst_file = local_thumb_file(path)
+        if not os.path.isdir(os.path.dirname(dst_file)):
+            os.makedirs(os.path.dirname(dst_file))
+        shutil.copyfile(src_file, dst_file)
+    return cache_dir
+
+def setup_engine(options):
+    # Measure the plain upload paths, whatever the site is configured for.
+    # Deferred thumbs would also start the upload queue.
+    config['s3.deferred_thumbs'] = 'false'
+    config['s3.immutable_thumbs'] = 'false'
+    config['s3.shared_default_thumbs'] = 'false'
+    pool = get_connection_pool()
+    pool.connection_kwargs = {
+        'host': options.host,
+        'port': options.port,
+        'is_secure': False,
+        'calling_format': OrdinaryCallingFormat(),
+    }
+    pool.clear()
+    engine = AmazonS3Storage()
+    engine.id = 0
+    engine._data = dict(AmazonS3Storage._default_data,
+        aws_access_key=u'benchmark',
+        aws_secret_key=u'benchmark',
+        s3_bucket_name=options.bucket.decode('utf-8'),
+        # Skip region discovery, the stand-in is reached through the pool
+        s3_region=u'us-east-1',
+    )
+    engine.connect().create_bucket(options.bucket)
+    # Keep the stand-in engine for the whole run, however long it takes,
+    # rather than reloading the site's engine once the entry expires
+    s3_engine_cache.set((engine, engine.download_url), 365 * 24 * 3600)
+    # Parts must be at least 5 MB, use the smallest allowed
+    config['s3.multipart_part_size'] = 5 * 1048576
+    return engine
+
+def run(options):
+    engine = setup_engine(options)
+    key_cache = get_s3_key_cache()
+    item = BenchItem(1)
+    default_item = BenchItem(2)
+    items = [BenchItem(i) for i in xrange(100, 100 + options.items)]
+    media_files = [BenchMediaFile(i, items[i % len(items)], engine)
+                   for i in xrange(10)]
+    results = []
+
+    def measure(name, func, *args, **kwargs):
+        metrics.start_request()
+        started = time.time()
+        error = result = None
+        try:
+            result = func(*args, **kwargs)
+        except Exception, e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+        elapsed = time.time() - started
+        counts = dict((verb, 0) for verb in VERBS)
+        sent = received = 0
+        for (hook, operation), stats in metrics.request_summary().iteritems():
+            # Sub-resource requests such as 'POST delete' count as their verb
+            verb = operation.split(' ')[0]
+            counts[verb] = counts.get(verb, 0) + stats.count
+            sent += stats.bytes_sent
+            received += stats.bytes_received
+        results.append((name, elapsed, counts, sent, received, error))
+        return result
+
+    def listing_page(exists):
+        for listed in items:
+            s3_thumb_url(listed, 's', exists=exists)
+
+    measure('connect_to_bucket', engine.connect_to_bucket)
+    measure('s3_create_thumbs_for', s3_create_thumbs_for, item,
+            make_image(), u'original.jpg')
+    key_cache.clear()
+    measure('s3_thumb_url exists (cold)', s3_thumb_url, item, 's', exists=True)
+    measure('s3_thumb_url exists (warm)', s3_thumb_url, item, 's', exists=True)
+    key_cache.clear()
+    measure('s3_thumb_path exists (cold)', s3_thumb_path, item, 's', exists=True)
+    key_cache.clear()
+    measure('s3_has_default_thumbs (cold)', s3_has_default_thumbs, item)
+    measure('s3_create_default_thumbs_for', s3_create_default_thumbs_for,
+            default_item)
+    key_cache.clear()
+    measure('s3_has_default_thumbs default (cold)', s3_has_default_thumbs,
+            default_item)
+    measure('s3_delete_thumbs', s3_delete_thumbs, item)
+    measure('s3_delete_thumbs default', s3_delete_thumbs, default_item)
+
+    for listed in items:
+        s3_create_default_thumbs_for(listed)
+    key_cache.clear()
+    measure('listing page %d items, no exists' % len(items),
+            listing_page, False)
+    measure('listing page %d items exists (cold)' % len(items),
+            listing_page, True)
+    measure('listing page %d items exists (warm)' % len(items),
+            listing_page, True)
+    key_cache.clear()
+    measure('s3_prefetch_thumbs %d items (cold)' % len(items),
+            s3_prefetch_thumbs, items, ['s'])
+    measure('listing page %d items exists (prefetched)' % len(items),
+            listing_page, True)
+
+    for media_file in media_files:
+        media_file.media.files.append(media_file)
+    measure('upload_stream %d MB' % options.stream_mb, engine.upload_stream,
+            media_files[0], make_chunks(options.stream_mb), u'benchmark.mp4')
+    for media_file in media_files[1:]:
+        engine.upload_stream(media_file, make_chunks(1), u'benchmark.mp4')
+    measure('get_local_path 1 MB (cold)', engine.get_local_path,
+            media_files[1])
+    measure('get_local_path 1 MB (warm)', engine.get_local_path,
+            media_files[1])
+    measure('copy_path 1 MB', engine.copy_path,
+            engine._get_path(media_files[1].unique_id),
+            engine._get_path(u'benchmark-copy.mp4'))
+
+    # The client's part uploads are made directly, as they would be by the
+    # browser, and aren't counted
+    chunked_file = BenchMediaFile(10, items[0], engine)
+    chunked_size = 6 * 1048576
+    upload = measure('prepare_for_chunked_upload',
+                     engine.prepare_for_chunked_upload, chunked_file,
+                     u'benchmark.mp4', chunked_size)
+    if upload:
+        mp = open_upload(engine.connect_to_bucket(),
+                         engine._key_name(chunked_file), upload['upload_id'])
+        part_size = upload['part_size']
+        def send_part(number):
+            mp.upload_part_from_file(StringIO('x' * min(part_size,
+                chunked_size - (number - 1) * part_size)), number)
+        # Interrupt the upload after its first part
+        send_part(upload['parts'][0]['part_number'])
+        upload = measure('prepare_for_chunked_upload (resume)',
+                         engine.prepare_for_chunked_upload, chunked_file,
+                         u'benchmark.mp4', chunked_size, upload['upload_id'])
+    if upload:
+        for part in upload['parts']:
+            send_part(part['part_number'])
+        measure('complete_chunked_upload', engine.complete_chunked_upload,
+                chunked_file, upload['upload_id'], chunked_size)
+    aborted_file = BenchMediaFile(11, items[0], engine)
+    upload = engine.prepare_for_chunked_upload(aborted_file, u'benchmark.mp4',
+                                               chunked_size)
+    measure('abort_chunked_upload', engine.abort_chunked_upload,
+            aborted_file, upload['upload_id'])
+
+    measure('prepare_for_upload', engine.prepare_for_upload, media_files[0],
+            'multipart/form-data', u'benchmark.mp4', 1048576)
+    measure('get_uris', engine.get_uris, media_files[0])
+    measure('delete', engine.delete, media_files[0])
+    measure('delete_many 5 files', engine.delete_many, media_files[1:6])
+    measure('s3_delete_many %d items' % len(items), s3_delete_many, items)
+    return results
+
+def print_results(results):
+    header = '%-42s %9s ' % ('Operation', 'ms') \
+        + ' '.join('%6s' % verb for verb in VERBS) \
+        + ' %6s %10s %10s' % ('total', 'KB sent', 'KB recv')
+    print header
+    print '-' * len(header)
+    for name, elapsed, counts, sent, received, error in results:
+        print '%-42s %9.1f ' % (name, elapsed * 1000) \
+            + ' '.join('%6d' % counts.get(verb, 0) for verb in VERBS) \
+            + ' %6d %10.1f %10.1f' % (sum(counts.values()),
+                                      sent / 1024.0, received / 1024.0)
+        if error:
+            print '    ERROR: %s' % error
+
+def compare(results, baseline_file):
+    """Return a list of operations that make more requests than before."""
+    f = open(baseline_file)
+    try:
+        baseline = simplejson.load(f)
+    finally:
+        f.close()
+    regressions = []
+    for name, elapsed, counts, sent, received, error in results:
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for verb in VERBS:
+            if counts.get(verb, 0) > before.get(verb, 0):
+                regressions.append('%s: %d %s requests, was %d' % (
+                    name, counts[verb], verb, before.get(verb, 0)))
+    return regressions
+
+def main(parser, options, args):
+    cache_dir = setup_cache_dir()
+    try:
+        results = run(options)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    print_results(results)
+
+    if options.save:
+        f = open(options.save, 'w')
+        try:
+            simplejson.dump(dict((name, counts) for name, elapsed, counts,
+                                 sent, received, error in results),
+                            f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    status = 0
+    if any(result[5] for result in results):
+        status = 1
+    if options.baseline:
+        regressions = compare(results, options.baseline)
+        for regression in regressions:
+            print 'REGRESSION: %s' % regression
+        if regressions:
+            status = 1
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main(cmd.parser, cmd.options, cmd.args)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python2.5
+# -*- coding: utf-8 -*-
+from mediacore.lib.commands import LoadAppCommand, load_app
+
+_script_name = "S3 orphan collection script"
+_script_description = """Finds the objects in the enabled Amazon S3 storage engine's bucket that no media file or media item refers to any more, such as those left behind by failed deletes, by rows removed from the database directly, by versioned thumbnails that have since been replaced, or by thumbnails left at their old keys by migrate-key-layout.py. Orphans are only reported unless --delete is given. The bucket listing is paged through lazily and checked against the database in chunks, so memory use doesn't grow with the size of the bucket."""
+DEBUG = False
+
+if __name__ == "__main__":
+    cmd = LoadAppCommand(_script_name, _script_description)
+    cmd.parser.add_option(
+        '--debug',
+        action='store_true',
+        dest='debug',
+        help='Write debug output to STDOUT.',
+        default=False
+    )
+    cmd.parser.add_option(
+        '--delete',
+        action='store_true',
+        dest='delete',
+        help='Delete the orphans instead of just listing them.',
+        default=False
+    )
+    cmd.parser.add_option(
+        '--min-age',
+        type='float',
+        dest='min_age',
+        help='Ignore objects modified less than this many hours ago, so '
+             'that uploads in progress are never mistaken for orphans.',
+        default=24
+    )
+    cmd.parser.add_option(
+        '--skip-media',
+        action='store_true',
+        dest='skip_media',
+        help="Don't check the media files.",
+        default=False
+    )
+    cmd.parser.add_option(
+        '--skip-thumbs',
+        action='store_true',
+        dest='skip_thumbs',
+        help="Don't check the thumbnails.",
+        default=False
+    )
+    cmd.parser.add_option(
+        '--abort-uploads',
+        action='store_true',
+        dest='abort_uploads',
+        help='Also abort multipart uploads that were started more than '
+             '--min-age hours ago and never completed.',
+        default=False
+    )
+    cmd.parser.add_option(
+        '--chunk-size',
+        type='int',
+        dest='chunk_size',
+        help='Number of keys to check against the database at a time.',
+        default=1000
+    )
+    load_app(cmd)
+    DEBUG = cmd.options.debug
+
+# BEGIN SCRIPT & SCRIPT SPECIFIC IMPORTS
+import calendar
+import re
+import sys
+import time
+
+from mediacore.lib.storage import StorageError
+from mediacore.model.media import Media, MediaFile
+from mediacore.model.meta import DBSession
+from mediacore.model.podcasts import Podcast
+
+from mediacore_aws import (get_s3_storage, pending_thumb_items,
+    s3_delete_keys, s3_forget_thumbs_for, thumb_shard_items,
+    thumb_version_items)
+from mediacore_aws.lib.storage import AmazonS3Storage, MULTI_DELETE_LIMIT
+from mediacore_aws.lib.util import chunked
+
+# Keys that are put in the bucket by hand or by other scripts
+PROTECTED_KEYS = frozenset(['crossdomain.xml'])
+
+_thumb_re = re.compile(r'^(?P<dir>[^/]+)/(?:(?P<shard>[0-9a-f]+)/)?'
+                       r'(?P<id>\d+)[^./\d][^./]*'
+                       r'(?:\.(?P<version>[0-9a-f]+))?\.[a-z0-9]+$')
+
+def parse_timestamp(timestamp):
+    """Convert a listing's ISO 8601 timestamp to seconds since the epoch."""
+    return calendar.timegm(time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
+
+def iter_keys(bucket, prefix, min_age, exclude_dirs=()):
+    """Yield the keys under the prefix that are old enough to check.
+
+    The listing is fetched a page at a time, as it's consumed.
+    """
+    cutoff = time.time() - min_age * 3600
+    for key in bucket.list(prefix=prefix):
+        if key.name in PROTECTED_KEYS or key.name.endswith('/'):
+            continue
+        if key.name.split('/', 1)[0] in exclude_dirs:
+            continue
+        if parse_timestamp(key.last_modified) > cutoff:
+            continue
+        yield key
+
+def find_media_orphans(keys, engines, chunk_size):
+    """Yield the keys that no media file in any of the engines refers to.
+
+    :param engines: The S3 engines that store their files in this bucket.
+    """
+    engines_by_id = dict((engine.id, engine) for engine in engines)
+    for chunk in chunked(keys, chunk_size):
+        # Unique IDs are relative to s3_bucket_dir, but older ones include
+        # it too, so look up both forms of each key.
+        candidates = set()
+        for key in chunk:
+            candidates.add(key.name)
+            for engine in engines:
+                base = engine._data['s3_bucket_dir'].strip('/')
+                if base and key.name.startswith(base + '/'):
+                    candidates.add(key.name[len(base) + 1:])
+        rows = DBSession.query(MediaFile.storage_id, MediaFile.unique_id)\
+            .filter(MediaFile.storage_id.in_(engines_by_id.keys()))\
+            .filter(MediaFile.unique_id.in_(list(candidates)))\
+            .all()
+        referenced = set()
+        for storage_id, unique_id in rows:
+            referenced.add(unique_id)
+            referenced.add(engines_by_id[storage_id]._get_path(unique_id))
+        for key in chunk:
+            if key.name not in referenced:
+                yield key
+
+def check_media_references(bucket, engines, sample_size):
+    """Make sure that the stored files of a sample of media files aren't
+    mistaken for orphans, before anything is deleted.
+
+    Each media file's key is looked up in the bucket in both forms its
+    unique ID may take, and whichever exists is run through
+    :func:`find_media_orphans`.
+
+    :returns: The names of the live keys that would have been deleted.
+    """
+    keys = []
+    for engine in engines:
+        media_files = DBSession.query(MediaFile)\
+            .filter(MediaFile.storage_id == engine.id)\
+            .order_by(MediaFile.id.desc())\
+            .limit(sample_size)
+        for media_file in media_files:
+            for name in set([media_file.unique_id,
+                             engine._get_path(media_file.unique_id)]):
+                key = bucket.get_key(name.encode('utf-8'))
+                if key is not None:
+                    keys.append(key)
+    return [key.name for key in find_media_orphans(keys, engines,
+                                                   sample_size)]
+
+def find_thumb_orphans(keys, item_class, chunk_size):
+    """Yield ``(item_id, key, exists)`` for thumbs of items that don't
+    exist, for versioned thumbs that aren't the item's current ones, and
+    for thumbs under a hashed prefix the item no longer uses.
+
+    The shared 'new' thumbs, the thumbs of items whose new thumbs are
+    still queued for upload, and keys we don't recognize, are never
+    considered orphans.
+    """
+    image_dir = item_class._thumb_dir
+    for chunk in chunked(keys, chunk_size):
+        thumbs = []
+        for key in chunk:
+            match = _thumb_re.match(key.name)
+            if match:
+                thumbs.append((int(match.group('id')), match.group('shard'),
+                               match.group('version'), key))
+            elif DEBUG:
+                print 'Skipping unrecognized key %s' % key.name
+        ids = list(set(thumb[0] for thumb in thumbs))
+        if not ids:
+            continue
+        existing = set(row[0] for row in DBSession.query(item_class.id)
+                       .filter(item_class.id.in_(ids)))
+        for item_id, shard, version, key in thumbs:
+            if item_id not in existing:
+                yield item_id, key, False
+            elif pending_thumb_items.get(image_dir, item_id):
+                continue
+            elif shard != thumb_shard_items.get(image_dir, item_id) \
+                    or version and version != thumb_version_items.get(
+                        image_dir, item_id):
+                yield item_id, key, True
+
+class Collector(object):
+    """Reports orphans and, if asked to, deletes them in batches."""
+
+    def __init__(self, storage, delete):
+        self.storage = storage
+        self.delete = delete
+        self.batch = []
+        self.items = set()
+        self.found = self.bytes = self.deleted = self.failed = 0
+
+    def add(self, key, item=None):
+        self.found += 1
+        self.bytes += int(key.size or 0)
+        if not self.delete or DEBUG:
+            print '%s\t%s\t%s' % (key.name, key.size, key.last_modified)
+        if not self.delete:
+            return
+        self.batch.append(key.name)
+        if item is not None:
+            self.items.add(item)
+        if len(self.batch) >= MULTI_DELETE_LIMIT:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        try:
+            s3_delete_keys(self.storage, self.batch)
+            self.deleted += len(self.batch)
+        except StorageError, e:
+            self.failed += len(self.batch)
+            print e
+        for item in self.items:
+            s3_forget_thumbs_for(item)
+        self.batch = []
+        self.items = set()
+
+def abort_stale_uploads(bucket, min_age, delete):
+    """Abort the multipart uploads that were started long ago."""
+    cutoff = time.time() - min_age * 3600
+    count = 0
+    for upload in bucket.list_multipart_uploads():
+        if parse_timestamp(upload.initiated) > cutoff:
+            continue
+        count += 1
+        if delete:
+            upload.cancel_upload()
+        print '%s upload %s of %s started %s' % (
+            delete and 'Aborted' or 'Stale', upload.id, upload.key_name,
+            upload.initiated)
+    return count
+
+def main(parser, options, args):
+    storage = get_s3_storage()
+    if storage is None:
+        print 'There is no enabled Amazon S3 storage engine.'
+        sys.exit(1)
+    bucket = storage.connect_to_bucket()
+    thumb_classes = dict((cls._thumb_dir, cls) for cls in (Media, Podcast))
+    collector = Collector(storage, options.delete)
+    started = time.time()
+
+    bucket_name = storage._data['s3_bucket_name']
+    engines = [engine for engine in DBSession.query(AmazonS3Storage)
+               if engine._data['s3_bucket_name'] == bucket_name]
+    bases = set(engine._data['s3_bucket_dir'].strip('/')
+                for engine in engines)
+    # Media files and thumbs under the same dir can't be told apart, e.g.
+    # media/123-my-video.mp4 looks like a thumb of item 123.
+    overlapping = [base for base in bases
+                   if base.split('/', 1)[0] in thumb_classes]
+    if overlapping:
+        print 'Refusing to run: the bucket dir %s is also a thumbnail dir, ' \
+              'so media files and thumbs would be mistaken for each other.' \
+              % ', '.join(sorted(overlapping))
+        sys.exit(1)
+
+    if not options.skip_media:
+        if options.delete:
+            live = check_media_references(bucket, engines, 20)
+            if live:
+                print 'Refusing to delete: these media files are in use ' \
+                      'but would be deleted as orphans:'
+                for name in live:
+                    print name
+                sys.exit(1)
+        if '' in bases:
+            # The whole bucket is listed anyway
+            bases = set([''])
+        # With no bucket dir the media files share the top level of the
+        # bucket with the thumbnail dirs, which are checked separately.
+        for base in bases:
+            prefix = base and base + '/' or ''
+            keys = iter_keys(bucket, prefix, options.min_age,
+                             exclude_dirs=not base and thumb_classes or ())
+            for key in find_media_orphans(keys, engines, options.chunk_size):
+                collector.add(key)
+
+    if not options.skip_thumbs:
+        for image_dir, item_class in thumb_classes.iteritems():
+            keys = iter_keys(bucket, image_dir + '/', options.min_age)
+            for item_id, key, exists in find_thumb_orphans(
+                    keys, item_class, options.chunk_size):
+                # Only forget the state of items that no longer exist
+                collector.add(key, not exists and (image_dir, item_id)
+                                   or None)
+
+    collector.flush()
+    stale_uploads = 0
+    if options.abort_uploads:
+        stale_uploads = abort_stale_uploads(bucket, options.min_age,
+                                            options.delete)
+
+    print '%d orphans (%.1f MB) found, %d deleted, %d failed, ' \
+          '%d stale uploads in %ds.' % (
+        collector.found, collector.bytes / 1048576.0, collector.deleted,
+        collector.failed, stale_uploads, time.time() - started)
+    sys.exit(collector.failed and 1 or 0)
+
+if __name__ == "__main__":
+    main(cmd.parser, cmd.options, cmd.args)
@@ -0,0 +1,220 @@
+#!/usr/bin/env python2.5
+# -*- coding: utf-8 -*-
+from mediacore.lib.commands import LoadAppCommand, load_app
+
+_script_name = "S3 key layout migration script"
+_script_description = """Moves the media files and thumbnails stored in the enabled Amazon S3 storage engine to the keys they'd have in the engine's current key layout, e.g. after switching it to spread keys across hashed prefixes. Objects are copied by S3 itself, so no data passes through this machine, and each file or item is switched over to its new keys once they're in place. The old keys are kept, so that cached pages that refer to them keep working, unless --delete-old is given. Running the script again only moves what hasn't been moved yet."""
+DEBUG = False
+
+if __name__ == "__main__":
+    cmd = LoadAppCommand(_script_name, _script_description)
+    cmd.parser.add_option(
+        '--debug',
+        action='store_true',
+        dest='debug',
+        help='Write debug output to STDOUT.',
+        default=False
+    )
+    cmd.parser.add_option(
+        '--workers',
+        type='int',
+        dest='workers',
+        help='Number of objects to copy at once.',
+        default=8
+    )
+    cmd.parser.add_option(
+        '--page-size',
+        type='int',
+        dest='page_size',
+        help='Number of media files or items to load and commit at a time.',
+        default=200
+    )
+    cmd.parser.add_option(
+        '--skip-media',
+        action='store_true',
+        dest='skip_media',
+        help="Don't move the media files.",
+        default=False
+    )
+    cmd.parser.add_option(
+        '--skip-thumbs',
+        action='store_true',
+        dest='skip_thumbs',
+        help="Don't move the thumbnails.",
+        default=False
+    )
+    cmd.parser.add_option(
+        '--delete-old',
+        action='store_true',
+        dest='delete_old',
+        help='Delete the old keys once the database or local state has '
+             'been updated. Otherwise collect-orphans.py can remove the '
+             'old thumbnails later.',
+        default=False
+    )
+    cmd.parser.add_option(
+        '--dry-run',
+        action='store_true',
+        dest='dry_run',
+        help='List what would be moved without copying anything.',
+        default=False
+    )
+    load_app(cmd)
+    DEBUG = cmd.options.debug
+
+# BEGIN SCRIPT & SCRIPT SPECIFIC IMPORTS
+import sys
+import time
+from threading import Lock
+
+from mediacore.lib.storage import StorageError
+from mediacore.model.media import Media, MediaFile
+from mediacore.model.meta import DBSession
+from mediacore.model.podcasts import Podcast
+
+from mediacore_aws import (get_s3_storage, s3_delete_keys,
+    s3_move_thumbs_to_layout, s3_thumb_shard, thumb_shard_items)
+from mediacore_aws.lib.workers import ParallelError, ThreadPool
+
+class Counters(object):
+    """Thread-safe counts of what was moved."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.moved = self.missing = self.failed = self.deleted = 0
+
+    def add(self, counter, count=1):
+        self.lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + count)
+        finally:
+            self.lock.release()
+
+def iter_pages(query, id_column, page_size):
+    """Yield pages of the query's results, in ID order."""
+    after_id = 0
+    while True:
+        page = query.filter(id_column > after_id)\
+            .order_by(id_column)\
+            .limit(page_size)\
+            .all()
+        if not page:
+            return
+        yield page
+        after_id = page[-1].id
+
+def move_media_files(engine, options, counters):
+    query = DBSession.query(MediaFile)\
+        .filter(MediaFile.storage_id == engine.id)
+    for page in iter_pages(query, MediaFile.id, options.page_size):
+        moves = []
+        for media_file in page:
+            unique_id = engine.layout_unique_id(media_file.unique_id)
+            if unique_id != media_file.unique_id:
+                moves.append((media_file, unique_id,
+                              engine._get_path(media_file.unique_id),
+                              engine._get_path(unique_id)))
+        if options.dry_run:
+            for media_file, unique_id, src_path, dst_path in moves:
+                print 'Would move %s to %s' % (src_path, dst_path)
+            counters.add('moved', len(moves))
+            continue
+
+        done = []
+        def move(media_file, unique_id, src_path, dst_path):
+            if not engine.copy_path(src_path, dst_path):
+                print '%s does not exist in S3' % src_path
+                counters.add('missing')
+                return
+            if DEBUG:
+                print 'Copied %s to %s' % (src_path, dst_path)
+            counters.lock.acquire()
+            try:
+                done.append((media_file, unique_id, src_path))
+            finally:
+                counters.lock.release()
+
+        pool = ThreadPool(options.workers, max_pending=options.workers)
+        for args in moves:
+            pool.submit(move, *args)
+        try:
+            pool.join()
+        except ParallelError, e:
+            # Those files keep their old keys and are retried next run
+            counters.add('failed', len(e.failures))
+            print e
+
+        for media_file, unique_id, src_path in done:
+            media_file.unique_id = unique_id
+        DBSession.commit()
+        counters.add('moved', len(done))
+
+        if options.delete_old and done:
+            try:
+                engine.delete_paths(src_path for media_file, unique_id,
+                                    src_path in done)
+                counters.add('deleted', len(done))
+            except StorageError, e:
+                print e
+
+def move_thumbs(engine, item_class, options, counters):
+    image_dir = item_class._thumb_dir
+    query = DBSession.query(item_class.id)
+    for page in iter_pages(query, item_class.id, options.page_size):
+        item_ids = [row.id for row in page]
+        if options.dry_run:
+            for item_id in item_ids:
+                if thumb_shard_items.get(image_dir, item_id) \
+                        != s3_thumb_shard(engine, item_id):
+                    print 'Would move the thumbs of %s/%s' % (image_dir,
+                                                               item_id)
+                    counters.add('moved')
+            continue
+
+        def move(item_id):
+            old_paths = s3_move_thumbs_to_layout(engine, (image_dir, item_id))
+            if old_paths is None:
+                return
+            if DEBUG:
+                print 'Moved the thumbs of %s/%s' % (image_dir, item_id)
+            counters.add('moved')
+            if options.delete_old and old_paths:
+                s3_delete_keys(engine, old_paths)
+                counters.add('deleted', len(old_paths))
+
+        pool = ThreadPool(options.workers, max_pending=options.workers)
+        for item_id in item_ids:
+            pool.submit(move, item_id)
+        try:
+            pool.join()
+        except ParallelError, e:
+            counters.add('failed', len(e.failures))
+            print e
+
+def main(parser, options, args):
+    # This engine is detached from the session, so committing the moved
+    # media files doesn't expire it under the worker threads.
+    engine = get_s3_storage()
+    if engine is None:
+        print 'There is no enabled Amazon S3 storage engine.'
+        sys.exit(1)
+    print 'Moving to the %s key layout.' % (engine.sharded and 'hashed'
+                                             or 'flat')
+
+    counters = Counters()
+    started = time.time()
+    if not options.skip_media:
+        move_media_files(engine, options, counters)
+    if not options.skip_thumbs:
+        for item_class in (Media, Podcast):
+            move_thumbs(engine, item_class, options, counters)
+
+    print '%d media files and items %s, %d missing, %d failed, ' \
+          '%d old keys deleted in %ds.' % (
+        counters.moved, options.dry_run and 'would be moved' or 'moved',
+        counters.missing, counters.failed, counters.deleted,
+        time.time() - started)
+    sys.exit(counters.failed and 1 or 0)
+
+if __name__ == "__main__":
+    main(cmd.parser, cmd.options, cmd.args)
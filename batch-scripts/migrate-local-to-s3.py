@@ -0,0 +1,351 @@
+#!/usr/bin/env python2.5
+# -*- coding: utf-8 -*-
+from mediacore.lib.commands import LoadAppCommand, load_app
+
+_script_name = "Local to S3 migration script"
+_script_description = """Moves media files stored with LocalFileStorage, and all locally stored thumbnails, into the enabled Amazon S3 storage engine. Progress is checkpointed so an interrupted run can be resumed by running the script again."""
+DEBUG = False
+
+if __name__ == "__main__":
+    cmd = LoadAppCommand(_script_name, _script_description)
+    cmd.parser.add_option(
+        '--debug',
+        action='store_true',
+        dest='debug',
+        help='Write debug output to STDOUT.',
+        default=False
+    )
+    cmd.parser.add_option(
+        '--workers',
+        type='int',
+        dest='workers',
+        help='Number of files to upload at once.',
+        default=8
+    )
+    cmd.parser.add_option(
+        '--page-size',
+        type='int',
+        dest='page_size',
+        help='Number of media files to load and commit at a time.',
+        default=200
+    )
+    cmd.parser.add_option(
+        '--checkpoint',
+        dest='checkpoint',
+        help='File to record progress in. Defaults to a file in cache.dir.',
+        default=None
+    )
+    cmd.parser.add_option(
+        '--restart',
+        action='store_true',
+        dest='restart',
+        help='Ignore any saved progress and start from the beginning.',
+        default=False
+    )
+    cmd.parser.add_option(
+        '--skip-thumbs',
+        action='store_true',
+        dest='skip_thumbs',
+        help="Don't upload the local thumbnails.",
+        default=False
+    )
+    cmd.parser.add_option(
+        '--delete-local',
+        action='store_true',
+        dest='delete_local',
+        help='Delete local files once they are in S3 and the database has '
+             'been updated.',
+        default=False
+    )
+    cmd.parser.add_option(
+        '--dry-run',
+        action='store_true',
+        dest='dry_run',
+        help='Report what would be done without uploading or committing.',
+        default=False
+    )
+    load_app(cmd)
+    DEBUG = cmd.options.debug
+
+# BEGIN SCRIPT & SCRIPT SPECIFIC IMPORTS
+import filecmp
+import mimetypes
+import os
+import posixpath
+import re
+import sys
+import time
+from hashlib import md5
+from threading import Lock
+
+from boto.s3.key import Key
+from pylons import config
+
+from mediacore.lib.storage.localfiles import LocalFileStorage
+from mediacore.model.media import MediaFile
+from mediacore.model.meta import DBSession
+
+from mediacore_aws import s3_thumb_key
+from mediacore_aws.lib.multipart import MultipartUploader
+from mediacore_aws.lib.storage import AmazonS3Storage
+from mediacore_aws.lib.workers import ThreadPool
+
+# Files larger than this are uploaded in parts
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+# Local thumbs are named <image_dir>/<item_id><size>.<ext>
+_thumb_re = re.compile(r'^(?P<id>\d+)(?P<size>[^./\d][^./]*)\.(?P<ext>[a-z0-9]+)$')
+
+class Progress(object):
+    """Thread-safe counters that print the throughput now and then."""
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.lock = Lock()
+        self.started = self.reported = time.time()
+        self.uploaded = self.skipped = self.failed = self.bytes = 0
+
+    def add(self, counter, nbytes=0):
+        self.lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+            self.bytes += nbytes
+            if time.time() - self.reported >= self.interval:
+                self.report()
+        finally:
+            self.lock.release()
+
+    def report(self):
+        self.reported = time.time()
+        elapsed = max(self.reported - self.started, 0.001)
+        print '%d uploaded, %d already in S3, %d failed, ' \
+              '%.1f MB in %ds (%.2f MB/s, %.1f files/s)' % (
+            self.uploaded, self.skipped, self.failed,
+            self.bytes / 1048576.0, elapsed,
+            self.bytes / 1048576.0 / elapsed,
+            (self.uploaded + self.skipped) / elapsed)
+        sys.stdout.flush()
+
+
+def file_md5(path):
+    digest = md5()
+    f = open(path, 'rb')
+    try:
+        for data in iter(lambda: f.read(READ_SIZE), ''):
+            digest.update(data)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+def already_uploaded(key, local_path, size, metadata=None):
+    """Return True if the key, as returned by a HEAD request, exists in S3
+    with the same content and metadata as the local file.
+
+    The local file is only read to hash it when a key of the same size
+    exists. Keys uploaded in parts don't have their MD5 as their ETag, so
+    we also compare against the MD5 we store in their metadata when
+    uploading them.
+    """
+    if key is None or int(key.size) != size:
+        return False
+    for name, value in (metadata or {}).iteritems():
+        if key.get_metadata(name) != value:
+            return False
+    local_md5 = file_md5(local_path)
+    return key.etag.strip('"') == local_md5 \
+        or key.get_metadata('md5') == local_md5
+
+def upload_file(engine, local_path, key_name, content_type, acl, progress,
+                dry_run=False, metadata=None):
+    """Upload a local file to the given key unless it's already there."""
+    try:
+        _upload_file(engine, local_path, key_name, content_type, acl,
+                     progress, dry_run, metadata)
+    except Exception:
+        progress.add('failed')
+        raise
+
+def _upload_file(engine, local_path, key_name, content_type, acl, progress,
+                 dry_run, metadata):
+    bucket = engine.connect_to_bucket()
+    size = os.path.getsize(local_path)
+    if already_uploaded(bucket.get_key(key_name), local_path, size,
+                        metadata):
+        progress.add('skipped')
+        return
+    if dry_run:
+        if DEBUG:
+            print 'Would upload %s to %s' % (local_path, key_name)
+        progress.add('uploaded', size)
+        return
+    headers = {'Content-Type': content_type or 'application/octet-stream'}
+    for name, value in (metadata or {}).iteritems():
+        headers['x-amz-meta-' + name] = value
+    f = open(local_path, 'rb')
+    try:
+        if size > MULTIPART_THRESHOLD:
+            headers['x-amz-meta-md5'] = file_md5(local_path)
+            uploader = MultipartUploader(bucket, key_name, headers, acl,
+                                         max_workers=2)
+            uploader.upload(f)
+        else:
+            # The ETag of a key uploaded in one request is its MD5
+            key = Key(bucket)
+            key.key = key_name
+            key.set_contents_from_file(f, headers, policy=acl)
+    finally:
+        f.close()
+    if DEBUG:
+        print 'Uploaded %s to %s' % (local_path, key_name)
+    progress.add('uploaded', size)
+
+def iter_media_files(local_engine_ids, after_id, page_size):
+    """Yield pages of locally stored media files, in ID order."""
+    while True:
+        page = DBSession.query(MediaFile)\
+            .filter(MediaFile.storage_id.in_(local_engine_ids))\
+            .filter(MediaFile.id > after_id)\
+            .order_by(MediaFile.id)\
+            .limit(page_size)\
+            .all()
+        if not page:
+            return
+        yield page
+        after_id = page[-1].id
+
+def migrate_media_files(s3_engine, options, progress, checkpoint):
+    local_engine_ids = [engine.id for engine in DBSession.query(LocalFileStorage)]
+    if not local_engine_ids:
+        return
+    after_id = read_checkpoint(checkpoint, options.restart)
+    # Once a file has failed, the checkpoint stays before it for the rest
+    # of the run, so that the next run retries it.
+    failed = False
+    for page in iter_media_files(local_engine_ids, after_id, options.page_size):
+        pool = ThreadPool(options.workers, max_pending=options.workers)
+        done = []
+        done_lock = Lock()
+
+        def migrate(media_file, unique_id, local_path, key_name,
+                    content_type):
+            upload_file(s3_engine, local_path, key_name, content_type,
+                        s3_engine.media_acl, progress, options.dry_run)
+            done_lock.acquire()
+            try:
+                done.append((media_file, unique_id, local_path))
+            finally:
+                done_lock.release()
+
+        for media_file in page:
+            local_path = media_file.storage._get_path(media_file.unique_id)
+            unique_id = s3_engine.layout_unique_id(media_file.unique_id)
+            key_name = s3_engine._get_path(unique_id)
+            pool.submit(migrate, media_file, unique_id, local_path, key_name,
+                        media_file.mimetype)
+        try:
+            pool.join()
+        except Exception, e:
+            # Failed files stay in local storage
+            print e
+
+        if options.dry_run:
+            continue
+
+        # The unique ID is the same relative path in S3, plus the hashed
+        # prefix if the engine uses the hashed key layout
+        done_ids = set(media_file.id for media_file, unique_id, local_path
+                       in done)
+        for media_file in page:
+            if failed or media_file.id not in done_ids:
+                failed = True
+                break
+            after_id = media_file.id
+        for media_file, unique_id, local_path in done:
+            media_file.storage = s3_engine
+            media_file.unique_id = unique_id
+        DBSession.commit()
+        write_checkpoint(checkpoint, after_id)
+
+        if options.delete_local:
+            for media_file, unique_id, local_path in done:
+                os.remove(local_path)
+
+def thumb_metadata(images_dir, key_name, local_path):
+    """Return the metadata to store a local thumb with.
+
+    Thumbs that are copies of the 'new' default thumbs are marked as such,
+    as s3_create_default_thumbs_for does, so that s3_has_default_thumbs
+    doesn't mistake them for custom thumbs once they're in S3.
+    """
+    image_dir, filename = posixpath.split(key_name)
+    match = _thumb_re.match(filename)
+    if not image_dir or not match:
+        return None
+    default_path = os.path.join(images_dir, *s3_thumb_key(image_dir, 'new',
+        match.group('size'), match.group('ext')).split('/'))
+    if os.path.exists(default_path) \
+            and filecmp.cmp(local_path, default_path, shallow=False):
+        return {'is_default_thumb': '1'}
+    return None
+
+def migrate_thumbs(s3_engine, options, progress):
+    """Upload every thumbnail in the local image store to the same path."""
+    images_dir = os.path.join(config['cache.dir'], 'images')
+    pool = ThreadPool(options.workers, max_pending=options.workers)
+    for dirpath, dirnames, filenames in os.walk(images_dir):
+        for filename in filenames:
+            local_path = os.path.join(dirpath, filename)
+            key_name = local_path[len(images_dir):].lstrip(os.sep)\
+                .replace(os.sep, '/')
+            pool.submit(upload_file, s3_engine, local_path, key_name,
+                        mimetypes.guess_type(filename)[0], 'public-read',
+                        progress, options.dry_run,
+                        thumb_metadata(images_dir, key_name, local_path))
+    try:
+        pool.join()
+    except Exception, e:
+        print e
+
+def read_checkpoint(checkpoint, restart):
+    if restart or not os.path.exists(checkpoint):
+        return 0
+    f = open(checkpoint)
+    try:
+        return int(f.read().strip() or 0)
+    finally:
+        f.close()
+
+def write_checkpoint(checkpoint, last_id):
+    tmp_path = checkpoint + '.tmp'
+    f = open(tmp_path, 'w')
+    try:
+        f.write(str(last_id))
+    finally:
+        f.close()
+    os.rename(tmp_path, checkpoint)
+
+def main(parser, options, args):
+    s3_engine = DBSession.query(AmazonS3Storage)\
+        .filter(AmazonS3Storage.enabled == True)\
+        .order_by(AmazonS3Storage.id)\
+        .first()
+    if s3_engine is None:
+        print 'There is no enabled Amazon S3 storage engine.'
+        sys.exit(1)
+
+    checkpoint = options.checkpoint or os.path.join(
+        config['cache.dir'], 's3', 'migrate-local-to-s3.checkpoint')
+    if not os.path.isdir(os.path.dirname(checkpoint)):
+        os.makedirs(os.path.dirname(checkpoint))
+
+    progress = Progress()
+    migrate_media_files(s3_engine, options, progress, checkpoint)
+    if not options.skip_thumbs:
+        migrate_thumbs(s3_engine, options, progress)
+    progress.report()
+
+    sys.exit(progress.failed and 1 or 0)
+
+if __name__ == "__main__":
+    main(cmd.parser, cmd.options, cmd.args)
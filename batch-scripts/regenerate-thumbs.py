@@ -0,0 +1,283 @@
+#!/usr/bin/env python2.5
+# -*- coding: utf-8 -*-
+from mediacore.lib.commands import LoadAppCommand, load_app
+
+_script_name = "S3 thumbnail regeneration script"
+_script_description = """Regenerates the thumbnails stored in the enabled Amazon S3 storage engine from the original images backed up by s3_create_thumbs_for, using the current thumb_sizes, s3.thumb_formats and s3.immutable_thumbs config. Run this after changing any of them. Each item's old thumbs are deleted once its new ones are uploaded."""
+DEBUG = False
+
+if __name__ == "__main__":
+    cmd = LoadAppCommand(_script_name, _script_description)
+    cmd.parser.add_option(
+        '--debug',
+        action='store_true',
+        dest='debug',
+        help='Write debug output to STDOUT.',
+        default=False
+    )
+    cmd.parser.add_option(
+        '--dir',
+        action='append',
+        dest='image_dirs',
+        help='Only regenerate thumbs in this thumb dir, e.g. media or '
+             'podcasts. May be given more than once. Defaults to all.',
+        default=None
+    )
+    cmd.parser.add_option(
+        '--from-id',
+        type='int',
+        dest='from_id',
+        help='Only regenerate thumbs for items with at least this ID.',
+        default=None
+    )
+    cmd.parser.add_option(
+        '--to-id',
+        type='int',
+        dest='to_id',
+        help='Only regenerate thumbs for items with at most this ID.',
+        default=None
+    )
+    cmd.parser.add_option(
+        '--processes',
+        type='int',
+        dest='processes',
+        help='Number of processes to resize images with. Defaults to the '
+             'number of CPUs.',
+        default=None
+    )
+    cmd.parser.add_option(
+        '--workers',
+        type='int',
+        dest='workers',
+        help='Number of threads to download and upload with.',
+        default=8
+    )
+    cmd.parser.add_option(
+        '--dry-run',
+        action='store_true',
+        dest='dry_run',
+        help='List the items that would be regenerated and exit.',
+        default=False
+    )
+    load_app(cmd)
+    DEBUG = cmd.options.debug
+
+# BEGIN SCRIPT & SCRIPT SPECIFIC IMPORTS
+import re
+import sys
+import time
+from multiprocessing import Pool, cpu_count
+from Queue import Queue
+from threading import Semaphore, Thread
+
+from boto.s3.key import Key
+from pylons import config
+
+from mediacore.model.media import Media
+from mediacore.model.meta import DBSession
+from mediacore.model.podcasts import Podcast
+
+from mediacore_aws import (IMMUTABLE_CACHE_CONTROL, get_s3_storage,
+    s3_immutable_thumbs, s3_publish_thumbs, s3_set_thumb_formats,
+    s3_thumb_formats, s3_thumb_key, s3_thumb_keys_for, s3_thumb_max_pixels,
+    s3_upload_public, thumb_shard_items)
+from mediacore_aws.lib.thumbnails import (THUMB_FORMATS,
+    render_thumbs_from_string, thumb_content_hash)
+from mediacore_aws.lib.util import chunked
+from mediacore_aws.lib.workers import ParallelError, ThreadPool
+
+_orig_re = re.compile(r'^(?P<dir>[^/]+)/(?:(?P<shard>[0-9a-f]+)/)?'
+                      r'(?P<id>\d+)orig\.[a-z0-9]+$')
+
+def iter_backups(bucket, image_dir, from_id, to_id):
+    """Yield ``(item_id, key_name)`` for each original image backed up
+    in the image dir at the item's current hashed prefix."""
+    for key in bucket.list(prefix=image_dir + '/'):
+        match = _orig_re.match(key.name)
+        if not match:
+            continue
+        item_id = int(match.group('id'))
+        if from_id is not None and item_id < from_id:
+            continue
+        if to_id is not None and item_id > to_id:
+            continue
+        if match.group('shard') != thumb_shard_items.get(image_dir, item_id):
+            continue
+        yield item_id, key.name
+
+def iter_originals(bucket, image_dirs, from_id, to_id, chunk_size=1000):
+    """Yield ``(image_dir, item_id, key_name)`` for each original image.
+
+    The bucket listing is paged through lazily, so this never holds more
+    than one page of keys in memory. Backups left at an item's old hashed
+    prefix, after it was moved to another key layout, are skipped, and so
+    are those of items that no longer exist.
+    """
+    item_classes = dict((cls._thumb_dir, cls) for cls in (Media, Podcast))
+    for image_dir in image_dirs:
+        item_class = item_classes.get(image_dir)
+        if item_class is None:
+            print 'Skipping %s, no kind of item has its thumbs there' \
+                % image_dir
+            continue
+        backups = iter_backups(bucket, image_dir, from_id, to_id)
+        for chunk in chunked(backups, chunk_size):
+            ids = list(set(item_id for item_id, key_name in chunk))
+            existing = set(row[0] for row in DBSession.query(item_class.id)
+                           .filter(item_class.id.in_(ids)))
+            for item_id, key_name in chunk:
+                if item_id in existing:
+                    yield image_dir, item_id, key_name
+
+def download_originals(bucket, originals, queue, workers, failures):
+    """Download each original into the queue, then put None at the end.
+
+    The queue should have a maximum size so that downloads pause while
+    the resizing processes catch up.
+
+    :param failures: A list that the number of failed downloads is
+        appended to.
+    """
+    def fetch(image_dir, item_id, key_name):
+        key = Key(bucket)
+        key.key = key_name
+        queue.put((image_dir, item_id, key.get_contents_as_string()))
+
+    pool = ThreadPool(workers, max_pending=workers)
+    try:
+        for original in originals:
+            pool.submit(fetch, *original)
+        pool.join()
+    except ParallelError, e:
+        failures.append(len(e.failures))
+        print e
+    except Exception, e:
+        # The listing failed, so the originals after it were never found
+        failures.append(1)
+        print e
+    queue.put(None)
+
+def iter_jobs(queue, semaphore, formats):
+    """Yield resize jobs from the download queue.
+
+    A multiprocessing pool consumes its input as fast as it can, so each
+    job waits on the semaphore, which is released once its result has
+    been handled. That bounds the number of images held in memory.
+    """
+    while True:
+        semaphore.acquire()
+        download = queue.get()
+        if download is None:
+            return
+        image_dir, item_id, data = download
+        yield (image_dir, item_id, data, config['thumb_sizes'][image_dir],
+               s3_thumb_max_pixels(), formats)
+
+def render_job(job):
+    """Resize an original into all sizes. Run in the process pool.
+
+    :returns: ``(image_dir, item_id, thumbs, version, error)``
+    """
+    image_dir, item_id, data, sizes, max_pixels, formats = job
+    try:
+        return (image_dir, item_id,
+                render_thumbs_from_string(data, sizes, max_pixels, formats),
+                thumb_content_hash(data, sizes), None)
+    except Exception, e:
+        return (image_dir, item_id, None, None,
+                '%s: %s' % (e.__class__.__name__, e))
+
+def upload_thumbs(storage, bucket, image_dir, item_id, thumbs, version,
+                  formats):
+    """Upload an item's new thumbs, then switch it over to them.
+
+    :param version: The thumbs' version, or None for unversioned keys.
+    """
+    obsolete = s3_thumb_keys_for((image_dir, item_id))
+    # The backup stays where it is, so keep the thumbs beside it
+    shard = thumb_shard_items.get(image_dir, item_id)
+    cache_control = version and IMMUTABLE_CACHE_CONTROL or None
+    for size, ext, data in thumbs:
+        s3_upload_public(bucket, s3_thumb_key(image_dir, item_id, size, ext,
+                                              version, shard),
+                         data, THUMB_FORMATS[ext][1], None, cache_control)
+    s3_set_thumb_formats(image_dir, item_id, formats)
+    s3_publish_thumbs(storage, image_dir, item_id, version, obsolete, shard)
+
+def main(parser, options, args):
+    storage = get_s3_storage()
+    if storage is None:
+        print 'There is no enabled Amazon S3 storage engine.'
+        sys.exit(1)
+    bucket = storage.connect_to_bucket()
+    image_dirs = options.image_dirs or config['thumb_sizes'].keys()
+    originals = iter_originals(bucket, image_dirs, options.from_id,
+                               options.to_id)
+
+    if options.dry_run:
+        count = 0
+        for image_dir, item_id, key_name in originals:
+            print 'Would regenerate %s/%s from %s' % (image_dir, item_id,
+                                                      key_name)
+            count += 1
+        print '%d items would be regenerated.' % count
+        sys.exit(0)
+
+    processes = options.processes or cpu_count()
+    max_in_flight = processes * 2
+    # Fork the resizing processes before starting any threads
+    process_pool = Pool(processes)
+    download_queue = Queue(max_in_flight)
+    semaphore = Semaphore(max_in_flight)
+    download_failures = []
+    downloader = Thread(target=download_originals,
+                        args=(bucket, originals, download_queue,
+                              options.workers, download_failures))
+    downloader.setDaemon(True)
+    downloader.start()
+
+    extra_formats = s3_thumb_formats()
+    immutable = s3_immutable_thumbs()
+    upload_pool = ThreadPool(options.workers, max_pending=options.workers * 4)
+    started = reported = time.time()
+    done = failed = 0
+    try:
+        results = process_pool.imap_unordered(
+            render_job, iter_jobs(download_queue, semaphore,
+                                  ['jpg'] + extra_formats))
+        for image_dir, item_id, thumbs, version, error in results:
+            semaphore.release()
+            if error:
+                failed += 1
+                print 'Failed to resize %s/%s: %s' % (image_dir, item_id, error)
+                continue
+            # Each item's thumbs are uploaded by one worker, so that the
+            # item is only switched over once all of them are in place.
+            upload_pool.submit(upload_thumbs, storage, bucket, image_dir,
+                               item_id, thumbs, immutable and version or None,
+                               extra_formats)
+            done += 1
+            if DEBUG:
+                print 'Regenerated %s/%s' % (image_dir, item_id)
+            if time.time() - reported >= 10:
+                reported = time.time()
+                print '%d items regenerated, %d failed (%.1f items/s)' % (
+                    done, failed, done / (reported - started))
+                sys.stdout.flush()
+    finally:
+        process_pool.close()
+        process_pool.join()
+        try:
+            upload_pool.join()
+        except ParallelError, e:
+            failed += len(e.failures)
+            print e
+    # The downloader is done once the results have all been handled
+    failed += sum(download_failures)
+
+    print '%d items regenerated, %d failures in %ds.' % (
+        done, failed, time.time() - started)
+    sys.exit(failed and 1 or 0)
+
+if __name__ == "__main__":
+    main(cmd.parser, cmd.options, cmd.args)
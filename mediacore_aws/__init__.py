@@ -1,70 +1,596 @@
 # This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
 
+import errno
+import filecmp
+import logging
 import mimetypes
 import os
-from tempfile import TemporaryFile
+import time
+from thread import get_ident
+from itertools import chain
+from threading import Lock
+from weakref import WeakKeyDictionary
+from cStringIO import StringIO
 from PIL import Image
+from boto.exception import S3ResponseError
 from boto.s3.key import Key
+from paste.deploy.converters import asbool, aslist
 from pylons import config, tmpl_context
 
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+try:
+    from sqlalchemy import event as sqlalchemy_event
+except ImportError:
+    sqlalchemy_event = None
+
 from mediacore.lib.thumbnails import (create_default_thumbs_for,
     create_thumbs_for, delete_thumbs, has_default_thumbs, normalize_thumb_item,
-    resize_thumb, thumb_path, thumb_paths, thumb_url, _ext_filter)
+    thumb_path, thumb_url, _ext_filter)
+from mediacore.lib.storage import StorageEngine, StorageError
 from mediacore.model.meta import DBSession
 from mediacore.plugin.events import observes
 
 # Import the Amazon Storage engine so that it is registered and usable.
+from mediacore_aws.lib.cache import S3KeyCache
+from mediacore_aws.lib.engines import invalidate_s3_storage, s3_engine_cache
+from mediacore_aws.lib.metrics import instrumented
+from mediacore_aws.lib.retry import DeadlineExceeded, get_retry_policy
+from mediacore_aws.lib.state import LocalItemStore
 from mediacore_aws.lib.storage import AmazonS3Storage
+from mediacore_aws.lib.thumbnails import (THUMB_FORMATS, encode_image,
+    format_supported, render_thumbs, thumb_content_hash)
+from mediacore_aws.lib.uploadqueue import UploadQueue
+from mediacore_aws.lib.util import hashed_prefix
+from mediacore_aws.lib.workers import ParallelError, ThreadPool
+
+log = logging.getLogger(__name__)
 
 
 # Helper functions for the retrieving the currently configured S3 engine.
 # This assumes that there will only be on S3 engine enabled at a time.
 
+def _load_s3_storage():
+    """Load the enabled S3 engine, detached from any session.
+
+    A separate session is used so that the engine can be cached and shared
+    between threads without interfering with the objects in any request's
+    session. If more than one S3 engine is enabled, the oldest is used.
+
+    :returns: A ``(storage, bucket_url)`` tuple, or ``(None, None)``.
+        The URL is the engine's download URL, see
+        :attr:`~mediacore_aws.lib.storage.AmazonS3Storage.download_url`.
+    """
+    session = DBSession.session_factory()
+    try:
+        engines = session.query(AmazonS3Storage)\
+            .filter(AmazonS3Storage.enabled == True)\
+            .order_by(AmazonS3Storage.id)\
+            .all()
+        if not engines:
+            return None, None
+        if len(engines) > 1:
+            log.warning('%d Amazon S3 storage engines are enabled, only the '
+                        'first (id %d) is used for thumbnails.',
+                        len(engines), engines[0].id)
+        engine = engines[0]
+        session.expunge(engine)
+        if s3_thumbs_deferred():
+            # Pick up any uploads left queued by an earlier process
+            thumb_upload_queue.start()
+        return engine, engine.download_url
+    finally:
+        session.close()
+
 def get_s3_storage():
     """Helper for retrieving the current S3 Storage engine.
 
-    We use this to get a boto connection to the configured bucket."""
-    c = tmpl_context._current_obj()
-    if getattr(c, '_s3_engine', ''):
-        if c._s3_engine == 'None':
-            return None
-        return c._s3_engine
-    engine = DBSession.query(AmazonS3Storage)\
-        .filter(AmazonS3Storage.enabled == True)\
-        .first()
-    c._s3_engine = engine or 'None'
-    return engine
+    We use this to get a boto connection to the configured bucket.
+
+    The engine is cached for the whole process, including outside of any
+    web request, see :class:`mediacore_aws.lib.engines.EngineCache`. It
+    is detached from the database session so it must be treated as read
+    only.
+    """
+    return s3_engine_cache.get(_load_s3_storage)[0]
 
 def get_s3_bucket_url():
     """Get the currently configured S3 bucket URL and cache it."""
-    c = tmpl_context._current_obj()
-    if getattr(c, '_s3_bucket_url', ''):
-        if c._s3_bucket_url == 'None':
-            return None
-        return c._s3_bucket_url
-    storage = get_s3_storage()
-    if storage:
-        c._s3_bucket_url = url = storage.bucket_url
-        return url
-    else:
-        c._s3_bucket_url = 'None'
+    return s3_engine_cache.get(_load_s3_storage)[1]
+
+# Sessions that have flushed changes to the S3 engines, or enabled or
+# disabled any engine, since they last committed or rolled back.
+_engine_change_sessions = WeakKeyDictionary()
+
+def _note_engine_changes(session, flush_context):
+    for obj in chain(session.new, session.deleted):
+        if isinstance(obj, StorageEngine):
+            _engine_change_sessions[session] = True
+            return
+    for obj in session.dirty:
+        if isinstance(obj, AmazonS3Storage) or isinstance(obj, StorageEngine) \
+                and get_history(obj, 'enabled').has_changes():
+            _engine_change_sessions[session] = True
+            return
+
+def _invalidate_after_commit(session):
+    if _engine_change_sessions.pop(session, False):
+        invalidate_s3_storage()
+
+def _forget_engine_changes(session, *args):
+    _engine_change_sessions.pop(session, None)
+
+# Forget the cached engine once a change to the engines is committed in
+# this process. Doing it any sooner would let another thread cache the
+# old engine again for s3.engine_cache_ttl. Other processes pick up the
+# change once their cache expires.
+if sqlalchemy_event is not None:
+    sqlalchemy_event.listen(Session, 'after_flush', _note_engine_changes)
+    sqlalchemy_event.listen(Session, 'after_commit', _invalidate_after_commit)
+    sqlalchemy_event.listen(Session, 'after_rollback', _forget_engine_changes)
+else:
+    # Older SQLAlchemy versions have no event API, and their session
+    # extensions can't be added to every session. Instead a mapper
+    # extension adds ours to each session that saves an engine.
+    from sqlalchemy.orm import class_mapper, object_session
+    from sqlalchemy.orm.interfaces import (EXT_CONTINUE, MapperExtension,
+        SessionExtension)
+
+    class _EngineChangeSessionExtension(SessionExtension):
+        def after_flush(self, session, flush_context):
+            _note_engine_changes(session, flush_context)
+
+        def after_commit(self, session):
+            _invalidate_after_commit(session)
+
+        def after_rollback(self, session):
+            _forget_engine_changes(session)
+
+    _session_extension = _EngineChangeSessionExtension()
+
+    class _EngineChangeMapperExtension(MapperExtension):
+        def _watch_session(self, mapper, connection, instance):
+            session = object_session(instance)
+            if session is not None \
+                    and _session_extension not in session.extensions:
+                session.extensions.append(_session_extension)
+            return EXT_CONTINUE
+
+        before_insert = before_update = before_delete = _watch_session
+
+    # Subclass mappers copied their extensions when they were created
+    _mapper_extension = _EngineChangeMapperExtension()
+    for _mapper in class_mapper(StorageEngine).polymorphic_iterator():
+        _mapper.extension.append(_mapper_extension)
+
+_key_cache = None
+_key_cache_lock = Lock()
+
+def get_s3_key_cache():
+    """Return the process-wide cache of S3 key existence and metadata.
+
+    The cache is created on first use so that its size and TTLs can be
+    read from the app config, which isn't loaded when we're imported.
+    """
+    global _key_cache
+    if _key_cache is None:
+        _key_cache_lock.acquire()
+        try:
+            if _key_cache is None:
+                _key_cache = S3KeyCache(
+                    max_size=int(config.get('s3.key_cache_size', 10000)),
+                    ttl=int(config.get('s3.key_cache_ttl', 300)),
+                    negative_ttl=int(config.get('s3.key_cache_negative_ttl', 60)),
+                )
+        finally:
+            _key_cache_lock.release()
+    return _key_cache
+
+def s3_key_metadata(storage, path):
+    """Return a dict of metadata for the given key or None if it's missing.
+
+    Only the metadata we use (``is_default_thumb``) is kept. Results,
+    including misses, are cached so that repeated lookups of the same
+    key don't each cost a HEAD request. The HEAD request is retried and
+    hedged, see :class:`mediacore_aws.lib.retry.RetryPolicy`.
+    """
+    cache = get_s3_key_cache()
+    bucket_name = storage._data['s3_bucket_name']
+    hit, metadata = cache.lookup(bucket_name, path)
+    if hit:
+        return metadata
+    bucket = storage.connect_to_bucket()
+    key = get_retry_policy('read').call(bucket.get_key, path)
+    if key is None:
+        cache.set_missing(bucket_name, path)
         return None
+    metadata = {}
+    if key.get_metadata('is_default_thumb'):
+        metadata['is_default_thumb'] = key.get_metadata('is_default_thumb')
+    cache.set_exists(bucket_name, path, metadata)
+    return metadata
 
-def s3_thumb_exists(path):
-    """Return True if a thumb exists for this item.
+def s3_upload_public(bucket, path, data, content_type, metadata=None,
+                     cache_control=None):
+    """Upload the given string to a new public-read key in the bucket.
+
+    The ACL is set as part of the same PUT request. The key cache is
+    updated to reflect the new key.
+
+    :param cache_control: The Cache-Control header for S3 and CloudFront
+        to serve the key with, if any.
+    :raises StorageError: If the upload fails.
+    """
+    key = Key(bucket)
+    key.key = path
+    for name, value in (metadata or {}).iteritems():
+        key.set_metadata(name, value)
+    headers = {'Content-Type': content_type}
+    if cache_control:
+        headers['Cache-Control'] = cache_control
+    try:
+        get_retry_policy('write').call(key.set_contents_from_string, data,
+                                       headers, policy='public-read')
+    except S3ResponseError, e:
+        raise StorageError('Failed to upload %s to S3: %s' % (path, e))
+    get_s3_key_cache().set_exists(bucket.name, path, metadata)
+
+# Items that are still using the shared default thumbnails. See
+# s3_create_default_thumbs_for for details.
+default_thumb_items = LocalItemStore('default_thumbs')
+
+def s3_thumb_key(image_dir, item_id, size, ext='jpg', version=None,
+                 shard=None):
+    """Return the key name for the given thumbnail within the bucket.
+
+    :param version: The hash of the thumbs' contents, if they're stored
+        under versioned keys, see :func:`s3_immutable_thumbs`.
+    :param shard: The hashed prefix the thumbs are stored under, if any,
+        see :func:`s3_thumb_shard`.
+    """
+    if shard:
+        image_dir = '%s/%s' % (image_dir, shard)
+    if version:
+        return '%s/%s%s.%s.%s' % (image_dir, item_id, size, version, ext)
+    return '%s/%s%s.%s' % (image_dir, item_id, size, ext)
+
+# The version of each item's current thumbs, for items whose thumbs are
+# stored under versioned keys.
+thumb_version_items = LocalItemStore('thumb_versions')
+
+# The hashed prefix each item's current thumbs are stored under, for items
+# whose thumbs were stored with the engine's hashed key layout.
+thumb_shard_items = LocalItemStore('thumb_shards')
+
+def s3_thumb_shard(storage, item_id):
+    """Return the hashed prefix for new thumbs of the item, or None if
+    the engine doesn't use the hashed key layout.
+
+    See :attr:`mediacore_aws.lib.storage.AmazonS3Storage.sharded`.
+    """
+    if item_id == 'new' or not storage.sharded:
+        return None
+    return hashed_prefix(str(item_id))
+
+def s3_item_thumb_key(image_dir, item_id, size, ext='jpg'):
+    """Return the key name of the item's current thumbnail.
+
+    The version and hashed prefix the item's thumbs are stored with are
+    read from the local state, so no S3 request is needed.
+    """
+    return s3_thumb_key(image_dir, item_id, size, ext,
+                        thumb_version_items.get(image_dir, item_id),
+                        thumb_shard_items.get(image_dir, item_id))
+
+# Versioned keys never change, so they can be cached for as long as
+# browsers and CloudFront allow.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def s3_immutable_thumbs():
+    """Return True if new thumbs should be stored under versioned keys.
+
+    When ``s3.immutable_thumbs`` is enabled each item's thumbs are stored
+    under keys that include a hash of their contents and are served with
+    :data:`IMMUTABLE_CACHE_CONTROL`. Replacing the thumbs changes their
+    URLs, so there are never stale copies to invalidate. The current
+    version of each item is kept locally so that URLs can be built
+    without asking S3.
+    """
+    return asbool(config.get('s3.immutable_thumbs', False))
+
+def _set_or_delete(store, image_dir, item_id, value):
+    if value:
+        store.set(image_dir, item_id, value)
+    else:
+        store.delete(image_dir, item_id)
+
+def s3_publish_thumbs(storage, image_dir, item_id, version, obsolete,
+                      shard=None):
+    """Point the item's thumbs at the given version and delete the keys
+    of the thumbs it replaced.
+
+    Call this once every key of the new version has been uploaded.
+
+    :param version: The new version, or None for unversioned keys.
+    :param obsolete: The item's keys from before the thumbs were
+        replaced, see :func:`s3_thumb_keys_for`. Those that are still in
+        use are kept.
+    :param shard: The hashed prefix of the new keys, if any.
+    """
+    _set_or_delete(thumb_version_items, image_dir, item_id, version)
+    _set_or_delete(thumb_shard_items, image_dir, item_id, shard)
+    current = set(s3_thumb_keys_for((image_dir, item_id)))
+    stale = [path for path in obsolete if path not in current]
+    if not stale:
+        return
+    try:
+        s3_delete_keys(storage, stale)
+    except StorageError, e:
+        # The old thumbs are no longer used, so this can be left to the
+        # orphan collection script.
+        log.warning('Failed to delete the old thumbs of %s/%s: %s',
+                    image_dir, item_id, e)
+
+# Items whose thumbs are waiting in the upload queue. The value is the
+# token of the latest job queued for the item.
+pending_thumb_items = LocalItemStore('pending_thumbs')
+
+def s3_thumbs_deferred():
+    """Return True if new thumbs should be uploaded in the background."""
+    return asbool(config.get('s3.deferred_thumbs', False))
+
+def local_thumb_file(path):
+    """Return the local filesystem path for the given thumbnail key."""
+    return os.path.join(config['cache.dir'], 'images', path)
+
+def write_local_thumb(path, data):
+    """Write a thumbnail to the local image store, ready to be served."""
+    file_path = local_thumb_file(path)
+    dirname = os.path.dirname(file_path)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+    tmp_path = '%s.%d.%d.tmp' % (file_path, os.getpid(), get_ident())
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(tmp_path, file_path)
+
+def _remove_local_thumbs(paths):
+    for path in paths:
+        try:
+            os.remove(local_thumb_file(path))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+@instrumented
+def _upload_queued_thumbs(job):
+    """Upload the local thumbs listed in a job from the upload queue.
+
+    Once every file is uploaded the item is no longer pending, so its
+    thumbs are served from S3, and the local copies are removed.
+    """
+    image_dir, item_id = job['image_dir'], job['item_id']
+    if pending_thumb_items.get(image_dir, item_id) != job['token']:
+        # The item was deleted, or a newer job replaced this one
+        return
+    storage = get_s3_storage()
+    if not storage:
+        raise StorageError('No Amazon S3 storage engine is enabled.')
+    bucket = storage.connect_to_bucket()
+    keys = job.get('keys', {})
+    pool = ThreadPool(int(config.get('s3.upload_threads', 6)))
+    try:
+        for path, content_type, metadata in job['files']:
+            f = open(local_thumb_file(path), 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            key_name, cache_control = keys.get(path, (path, None))
+            pool.submit(s3_upload_public, bucket, key_name, data,
+                        content_type, metadata, cache_control)
+    finally:
+        pool.join()
+    if pending_thumb_items.get(image_dir, item_id) == job['token']:
+        if 'obsolete' in job:
+            s3_publish_thumbs(storage, image_dir, item_id, job['version'],
+                              job['obsolete'], job.get('shard'))
+        pending_thumb_items.delete(image_dir, item_id)
+        _remove_local_thumbs(path for path, content_type, metadata
+                             in job['files'])
+
+# Durable queue of thumbs waiting to be uploaded when s3.deferred_thumbs
+# is enabled. Jobs are kept under cache.dir so they survive restarts.
+thumb_upload_queue = UploadQueue('thumb_uploads', _upload_queued_thumbs)
+
+def s3_queue_thumbs(image_dir, item_id, files, keys=None, version=None,
+                    obsolete=(), shard=None):
+    """Queue thumbs from the local image store to be uploaded to S3.
+
+    Until the upload completes the item is pending, and
+    :func:`s3_thumb_url` and :func:`s3_thumb_path` fall back to the
+    local thumbs. Once it completes the thumbs are published with
+    :func:`s3_publish_thumbs`.
+
+    :param files: ``(path, content_type, metadata)`` tuples for files that
+        have been written with :func:`write_local_thumb`.
+    :param keys: A dict of ``(key_name, cache_control)`` tuples for the
+        paths that are to be uploaded to a different key, such as a
+        versioned one, or with a Cache-Control header.
+    :param version: The version of the thumbs, see :func:`s3_thumb_key`.
+    :param obsolete: The keys to delete once the upload is done.
+    :param shard: The hashed prefix of the thumbs' keys, if any.
+    """
+    token = '%f.%d' % (time.time(), os.getpid())
+    pending_thumb_items.set(image_dir, item_id, token)
+    thumb_upload_queue.put('%s-%s' % (image_dir, item_id), {
+        'image_dir': image_dir,
+        'item_id': item_id,
+        'token': token,
+        'files': list(files),
+        'keys': keys or {},
+        'version': version,
+        'obsolete': list(obsolete),
+        'shard': shard,
+    })
+
+# The extra formats, besides JPEG, that each item's thumbs exist in, as
+# a space separated list of extensions.
+thumb_format_items = LocalItemStore('thumb_formats')
+
+# About 50 megapixels, e.g. 8660x5773, which covers the originals of
+# current cameras while bounding the memory a single decode can take.
+DEFAULT_THUMB_MAX_PIXELS = 50000000
+
+def s3_thumb_max_pixels():
+    """Return the most pixels an original may decode to, or None.
+
+    This is the ``s3.thumb_max_pixels`` config setting, which defaults to
+    :data:`DEFAULT_THUMB_MAX_PIXELS`. Set it to 0 to allow originals of
+    any size.
+    """
+    return int(config.get('s3.thumb_max_pixels',
+                          DEFAULT_THUMB_MAX_PIXELS)) or None
+
+def s3_thumb_formats():
+    """Return the extensions of the extra formats to render thumbs in.
+
+    These are listed in the ``s3.thumb_formats`` config setting, e.g.
+    ``avif webp``, in order of preference. Formats that the installed
+    PIL can't encode are skipped.
+    """
+    formats = []
+    for ext in aslist(config.get('s3.thumb_formats', '')):
+        ext = ext.lower()
+        if ext == 'jpg':
+            continue
+        if not format_supported(ext):
+            log.warning('Thumbnails cannot be rendered as %s, check that '
+                        'PIL supports it.', ext)
+            continue
+        formats.append(ext)
+    return formats
+
+def s3_thumb_item(item):
+    """Normalize the item, resolving it to 'new' if it uses shared defaults.
 
     :param item: A 2-tuple with a subdir name and an ID. If given a
         ORM mapped class with _thumb_dir and id attributes, the info
         can be extracted automatically.
     :type item: ``tuple`` or mapped class instance
+    :returns: An ``(image_dir, item_id)`` tuple.
+    """
+    image_dir, item_id = normalize_thumb_item(item)
+    if item_id != 'new' and default_thumb_items.get(image_dir, item_id):
+        return image_dir, 'new'
+    return image_dir, item_id
+
+def _prefetched_thumbs(create=False):
+    """Return the current request's map of prefetched thumb paths.
+
+    :param create: Create the map if the request doesn't have one yet.
+    :returns: A dict of paths and whether they exist, or None if there is
+        no map or we aren't in a request, e.g. in a batch script.
     """
+    try:
+        prefetched = getattr(tmpl_context, 's3_thumbs', None)
+        if prefetched is None and create:
+            prefetched = tmpl_context.s3_thumbs = {}
+    except TypeError:
+        # No tmpl_context is registered for this thread
+        return None
+    return prefetched
+
+@instrumented
+def s3_prefetch_thumbs(items, sizes, exts=('jpg',)):
+    """Find out which of the given thumbnails exist, all at once.
+
+    Call this before rendering a page that shows many items' thumbs with
+    ``exists=True``. Keys that aren't in the key cache are looked up with
+    concurrent HEAD requests, ``s3.prefetch_threads`` at a time, and the
+    results are kept for the rest of the request so that each following
+    :func:`s3_thumb_url` or :func:`s3_thumb_path` call needs no request.
+
+    :param items: The items, as accepted by :func:`s3_thumb_url`.
+    :param sizes: The size names that will be displayed.
+    :param exts: The formats that will be displayed.
+    :returns: A dict of thumb paths and whether they exist, or None if no
+        S3 engine is enabled.
+    """
+    storage = get_s3_storage()
+    if not storage:
+        return None
+    paths = set()
+    for item in items:
+        if not item or pending_thumb_items.get(*normalize_thumb_item(item)):
+            continue
+        image_dir, item_id = s3_thumb_item(item)
+        for size in sizes:
+            for ext in exts:
+                paths.add(s3_item_thumb_key(image_dir, item_id, size, ext))
+
+    results = {}
+    def lookup(path):
+        try:
+            results[path] = s3_key_metadata(storage, path) is not None
+        except DeadlineExceeded, e:
+            # Assume it's there, like s3_thumb_exists, rather than have
+            # each thumb looked up again one by one while the page renders
+            log.warning('Assuming %s exists: %s', path, e)
+            results[path] = True
+
+    # Cached keys are resolved right away, without using a thread
+    key_cache = get_s3_key_cache()
+    bucket_name = storage._data['s3_bucket_name']
+    pool = ThreadPool(int(config.get('s3.prefetch_threads', 16)))
+    for path in paths:
+        hit, metadata = key_cache.lookup(bucket_name, path)
+        if hit:
+            results[path] = metadata is not None
+        else:
+            pool.submit(lookup, path)
+    try:
+        pool.join()
+    except ParallelError, e:
+        # Those thumbs will be looked up again if they're displayed
+        log.warning('Failed to prefetch %d thumbs: %s', len(e.failures), e)
+
+    prefetched = _prefetched_thumbs(create=True)
+    if prefetched is not None:
+        prefetched.update(results)
+    return results
+
+def s3_thumb_exists(path):
+    """Return True if a thumb exists at the given path.
+
+    Thumbs found by :func:`s3_prefetch_thumbs` earlier in the request
+    aren't looked up again.
+
+    :param path: The relative path of the thumbnail within the bucket.
+    :type path: str
+    """
+    prefetched = _prefetched_thumbs()
+    if prefetched is not None and path in prefetched:
+        return prefetched[path]
     # if this is called we've already verified a s3 is enabled
     storage = get_s3_storage()
-    bucket = storage.connect_to_bucket()
-    return bool(bucket.get_key(path))
+    try:
+        return s3_key_metadata(storage, path) is not None
+    except DeadlineExceeded, e:
+        # Rather than fail or stall the page, assume the thumb is there
+        log.warning('Assuming %s exists: %s', path, e)
+        return True
 
 
 @observes(thumb_path, appendleft=True)
+@instrumented
 def s3_thumb_path(item, size, exists=False, ext='jpg'):
     """Get the thumbnail path for the given item and size.
 
@@ -92,16 +618,20 @@ def s3_thumb_path(item, size, exists=False, ext='jpg'):
     if not bucket_url:
         return None
 
-    image_dir, item_id = normalize_thumb_item(item)
-    image = '%s/%s%s.%s' % (image_dir, item_id, size, ext)
-    image_path = image # use the relative path
+    # Serve the local copies until the queued upload has completed
+    if pending_thumb_items.get(*normalize_thumb_item(item)):
+        return None
+
+    image_dir, item_id = s3_thumb_item(item)
+    image_path = s3_item_thumb_key(image_dir, item_id, size, ext)
 
     if exists and not s3_thumb_exists(image_path):
         return None
     return image_path
 
 @observes(thumb_url, appendleft=True)
-def s3_thumb_url(item, size, qualified=False, exists=False):
+@instrumented
+def s3_thumb_url(item, size, qualified=False, exists=False, ext='jpg'):
     """Get the thumbnail url for the given item and size.
 
     :param item: A 2-tuple with a subdir name and an ID. If given a
@@ -116,6 +646,10 @@ def s3_thumb_url(item, size, qualified=False, exists=False):
     :param exists: If enabled, checks to see if the file actually exists.
         If it doesn't exist, ``None`` is returned.
     :type exists: bool
+    :param ext: The extension to use, defaults to jpg. Use
+        :func:`s3_thumb_variant_urls` to find out which other formats
+        the item's thumbs exist in.
+    :type ext: str
     :returns: The relative or absolute URL.
     :rtype: str
 
@@ -128,15 +662,42 @@ def s3_thumb_url(item, size, qualified=False, exists=False):
     if not bucket_url:
         return None
 
-    image_dir, item_id = normalize_thumb_item(item)
-    image = '%s/%s%s.jpg' % (image_dir, item_id, size)
-    image_path = image # use the relative path
+    # Serve the local copies until the queued upload has completed
+    if pending_thumb_items.get(*normalize_thumb_item(item)):
+        return None
+
+    image_dir, item_id = s3_thumb_item(item)
+    image_path = s3_item_thumb_key(image_dir, item_id, size, ext)
 
-    if exists and not s3_thumb_exists(image):
+    if exists and not s3_thumb_exists(image_path):
         return None
-    return bucket_url + image
+    return bucket_url + image_path
+
+def s3_thumb_variant_urls(item, size):
+    """Return the URLs of the extra formats the item's thumb exists in.
+
+    These can be listed as ``<source>`` elements in a ``<picture>``, in
+    front of the JPEG from :func:`s3_thumb_url`. Items whose thumbs were
+    made before ``s3.thumb_formats`` was set, or whose thumbs are still
+    being uploaded, have none.
+
+    :returns: A list of ``(content_type, url)`` tuples, in order of
+        preference.
+    """
+    if not item:
+        return []
+    bucket_url = get_s3_bucket_url()
+    if not bucket_url:
+        return []
+    if pending_thumb_items.get(*normalize_thumb_item(item)):
+        return []
+    image_dir, item_id = s3_thumb_item(item)
+    return [(THUMB_FORMATS[ext][1],
+             bucket_url + s3_item_thumb_key(image_dir, item_id, size, ext))
+            for ext in thumb_format_items.get(image_dir, item_id, '').split()]
 
 @observes(create_thumbs_for, appendleft=True)
+@instrumented
 def s3_create_thumbs_for(item, image_file, image_filename):
     """Creates thumbnails in all sizes for a given Media or Podcast object.
 
@@ -150,51 +711,98 @@ def s3_create_thumbs_for(item, image_file, image_filename):
     :type image_file: file
     :param image_filename: The original filename of the thumbnail image.
     :type image_filename: unicode
+
+    If ``s3.deferred_thumbs`` is enabled in the config, the thumbs are
+    written to the local image store and uploaded by a background worker,
+    see :func:`s3_queue_thumbs`.
+
+    If ``s3.immutable_thumbs`` is enabled, the thumbs are uploaded under
+    new versioned keys, see :func:`s3_immutable_thumbs`. Either way the
+    thumbs they replace are deleted once the upload is done.
     """
     # fallback to normal thumb handling if no S3 engine is enabled.
     storage = get_s3_storage()
     if not storage:
         return None
-    bucket = storage.connect_to_bucket()
-
     image_dir, item_id = normalize_thumb_item(item)
-    img = Image.open(image_file)
-
-    # TODO: Allow other formats?
-    for key, xy in config['thumb_sizes'][item._thumb_dir].iteritems():
-        path = thumb_path(item, key)
-        thumb_img = resize_thumb(img, xy)
-        if thumb_img.mode != "RGB":
-            thumb_img = thumb_img.convert("RGB")
+    obsolete = s3_thumb_keys_for(item)
+    shard = s3_thumb_shard(storage, item_id)
 
-        tmpfile = TemporaryFile()
-        thumb_img.save(tmpfile, 'JPEG')
+    version = cache_control = None
+    if s3_immutable_thumbs():
+        image_file.seek(0)
+        version = thumb_content_hash(image_file.read(),
+                                     config['thumb_sizes'][image_dir])
+        image_file.seek(0)
+        cache_control = IMMUTABLE_CACHE_CONTROL
 
-        key = Key(bucket)
-        key.key = path
-        key.set_contents_from_file(tmpfile, {'Content-Type': 'image/jpeg'})
-        key.set_acl('public-read')
+    deferred = s3_thumbs_deferred()
+    if deferred:
+        # Write the files locally now and upload them in the background.
+        # The local copies keep their plain paths, so that they're found
+        # by the local thumb handling in the meantime.
+        queued = []
+        keys = {}
+        def upload(path, data, content_type, key_name=None,
+                   cache_control=None):
+            write_local_thumb(path, data)
+            queued.append((path, content_type, None))
+            if key_name:
+                keys[path] = (key_name, cache_control)
+    else:
+        bucket = storage.connect_to_bucket()
+        pool = ThreadPool(int(config.get('s3.upload_threads', 6)))
+        def upload(path, data, content_type, key_name=None,
+                   cache_control=None):
+            pool.submit(s3_upload_public, bucket, key_name or path, data,
+                        content_type, None, cache_control)
 
     # Backup the original image, ensuring there's no odd chars in the ext.
     # Thumbs from DailyMotion include an extra query string that needs to be
-    # stripped off here.
+    # stripped off here. This is the largest upload so it is started first.
     ext = os.path.splitext(image_filename)[1].lower()
     ext_match = _ext_filter.match(ext)
     if ext_match:
         backup_type = ext_match.group(1)
-        backup_path = thumb_path(item, 'orig', ext=backup_type)
+        backup_path = s3_thumb_key(image_dir, item_id, 'orig', backup_type)
+        image_file.seek(0)
+        upload(backup_path, image_file.read(),
+               mimetypes.guess_type(backup_path)[0],
+               s3_thumb_key(image_dir, item_id, 'orig', backup_type, None,
+                            shard))
         image_file.seek(0)
 
-        key = Key(bucket)
-        key.key = backup_path
-        key.set_contents_from_file(image_file,
-            {'Content-Type': mimetypes.guess_type(backup_path)[0]})
-        key.set_acl('public-read')
+    # Each thumb is uploaded while the next one is being resized.
+    extra_formats = s3_thumb_formats()
+    try:
+        img = Image.open(image_file)
+        for key, ext, data in render_thumbs(
+                img, config['thumb_sizes'][image_dir], s3_thumb_max_pixels(),
+                ['jpg'] + extra_formats):
+            upload(s3_thumb_key(image_dir, item_id, key, ext), data,
+                   THUMB_FORMATS[ext][1],
+                   s3_thumb_key(image_dir, item_id, key, ext, version, shard),
+                   cache_control)
+    finally:
+        # Always wait for uploads that have already started to finish
+        # before returning or re-raising.
+        if not deferred:
+            pool.join()
 
-        image_file.close()
+    s3_set_thumb_formats(image_dir, item_id, extra_formats)
+    # The item now has thumbs of its own, so stop using the shared defaults
+    default_thumb_items.delete(image_dir, item_id)
+    if deferred:
+        s3_queue_thumbs(image_dir, item_id, queued, keys, version, obsolete,
+                        shard)
+    else:
+        s3_publish_thumbs(storage, image_dir, item_id, version, obsolete,
+                          shard)
+    image_file.close()
     return True
 
 @observes(create_default_thumbs_for, appendleft=True)
+@instrumented
 def s3_create_default_thumbs_for(item):
     """Create copies of the default thumbs for the given item.
 
@@ -203,6 +811,16 @@ def s3_create_default_thumbs_for(item):
     copies of the default thumbs, but at least we can always use the
     same url when rendering.
 
+    If ``s3.shared_default_thumbs`` is enabled in the config, no copies
+    are made. Instead the defaults are uploaded once under the 'new' id
+    and the item is flagged locally so that :func:`s3_thumb_url` and
+    :func:`s3_thumb_path` resolve it to those shared keys until it gets
+    thumbs of its own.
+
+    If ``s3.deferred_thumbs`` is enabled, the copies are made locally and
+    uploaded in the background. The shared defaults are always uploaded
+    right away, since that only happens once.
+
     :param item: A 2-tuple with a subdir name and an ID. If given a
         ORM mapped class with _thumb_dir and id attributes, the info
         can be extracted automatically.
@@ -213,24 +831,148 @@ def s3_create_default_thumbs_for(item):
     if not storage:
         return None
     bucket = storage.connect_to_bucket()
-
+    pool = ThreadPool(int(config.get('s3.upload_threads', 6)))
     image_dir, item_id = normalize_thumb_item(item)
+    # Defaults are never versioned, so any versioned thumbs are replaced
+    obsolete = s3_thumb_keys_for(item)
+
+    shared = asbool(config.get('s3.shared_default_thumbs', False))
+    if shared:
+        item_id = 'new'
+    shard = s3_thumb_shard(storage, item_id)
+    deferred = not shared and s3_thumbs_deferred()
+    extra_formats = s3_thumb_formats()
+    queued = []
+    keys = {}
 
     for key in config['thumb_sizes'][image_dir].iterkeys():
-        src_file = os.path.join(config['cache.dir'], 'images', thumb_path((image_dir, 'new'), key))
-        dst_file = thumb_path(item, key)
-        key = Key(bucket)
-        key.key = dst_file
-
-        key.set_metadata('is_default_thumb', '1')
-        key.set_contents_from_filename(src_file, {'Content-Type': 'image/jpeg'})
-        key.set_acl('public-read')
+        src_file = local_thumb_file(s3_thumb_key(image_dir, 'new', key))
+        f = open(src_file, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        for ext in ['jpg'] + extra_formats:
+            dst_file = s3_thumb_key(image_dir, item_id, key, ext)
+            dst_key = s3_thumb_key(image_dir, item_id, key, ext, None, shard)
+            if shared and s3_key_metadata(storage, dst_key) is not None:
+                continue
+            if ext == 'jpg':
+                dst_data = data
+            else:
+                dst_data = encode_image(Image.open(StringIO(data)), ext)
+            content_type = THUMB_FORMATS[ext][1]
+            if deferred:
+                write_local_thumb(dst_file, dst_data)
+                queued.append((dst_file, content_type,
+                               {'is_default_thumb': '1'}))
+                keys[dst_file] = (dst_key, None)
+            else:
+                pool.submit(s3_upload_public, bucket, dst_key, dst_data,
+                            content_type, {'is_default_thumb': '1'})
+    pool.join()
+
+    s3_set_thumb_formats(image_dir, item_id, extra_formats)
+    if shared:
+        default_thumb_items.set(*normalize_thumb_item(item))
+    if deferred:
+        s3_queue_thumbs(image_dir, item_id, queued, keys, None, obsolete,
+                        shard)
+    else:
+        image_dir, item_id = normalize_thumb_item(item)
+        s3_publish_thumbs(storage, image_dir, item_id, None, obsolete, shard)
     return True
 
+def s3_set_thumb_formats(image_dir, item_id, formats):
+    """Record the extra formats the item's thumbs have been rendered in."""
+    if formats:
+        thumb_format_items.set(image_dir, item_id, ' '.join(formats))
+    else:
+        thumb_format_items.delete(image_dir, item_id)
+
+def s3_thumb_keys_for(item):
+    """Return the key names of all the thumbs the given item has of its own,
+    in every format.
+
+    Items that are on the shared default thumbs have none.
+    """
+    image_dir, item_id = normalize_thumb_item(item)
+    if default_thumb_items.get(image_dir, item_id):
+        return []
+    formats = ['jpg'] + thumb_format_items.get(image_dir, item_id, '').split()
+    return [s3_item_thumb_key(image_dir, item_id, size, ext)
+            for size in config['thumb_sizes'][image_dir]
+            for ext in formats]
+
+@instrumented
+def s3_move_thumbs_to_layout(storage, item):
+    """Copy the item's thumbs to their keys in the engine's key layout.
+
+    The copies are made by S3, and the item is switched over to them once
+    they're all in place. The original image backup is moved too. Items
+    on the shared default thumbs, or whose thumbs are waiting to be
+    uploaded, are left alone.
+
+    :returns: The keys that are no longer used, for the caller to delete
+        once pages that refer to them have expired, or None if there was
+        nothing to move.
+    :raises StorageError: If a copy fails. The item keeps using its old
+        keys.
+    """
+    image_dir, item_id = normalize_thumb_item(item)
+    if pending_thumb_items.get(image_dir, item_id) \
+            or default_thumb_items.get(image_dir, item_id):
+        return None
+    shard = thumb_shard_items.get(image_dir, item_id)
+    new_shard = s3_thumb_shard(storage, item_id)
+    if shard == new_shard:
+        return None
+    version = thumb_version_items.get(image_dir, item_id)
+    formats = ['jpg'] + thumb_format_items.get(image_dir, item_id, '').split()
+    moves = [(s3_thumb_key(image_dir, item_id, size, ext, version, shard),
+              s3_thumb_key(image_dir, item_id, size, ext, version, new_shard))
+             for size in config['thumb_sizes'][image_dir]
+             for ext in formats]
+    # The backup's extension is whatever the uploaded image's was
+    orig_prefix = s3_thumb_key(image_dir, item_id, 'orig', '', None, shard)
+    for key in storage.connect_to_bucket().list(prefix=orig_prefix):
+        moves.append((key.name, s3_thumb_key(image_dir, item_id, 'orig',
+            key.name[len(orig_prefix):], None, new_shard)))
+
+    key_cache = get_s3_key_cache()
+    bucket_name = storage._data['s3_bucket_name']
+    moved = []
+    for src_path, dst_path in moves:
+        if storage.copy_path(src_path, dst_path, 'public-read'):
+            key_cache.forget(bucket_name, dst_path)
+            moved.append(src_path)
+    _set_or_delete(thumb_shard_items, image_dir, item_id, new_shard)
+    return moved
+
+def s3_forget_thumbs_for(item):
+    """Forget the local state kept for the given item's thumbs.
+
+    Any upload still queued for the item is cancelled and its local
+    copies are removed.
+    """
+    image_dir, item_id = normalize_thumb_item(item)
+    default_thumb_items.delete(image_dir, item_id)
+    thumb_format_items.delete(image_dir, item_id)
+    thumb_version_items.delete(image_dir, item_id)
+    thumb_shard_items.delete(image_dir, item_id)
+    pending_thumb_items.delete(image_dir, item_id)
+    job = thumb_upload_queue.cancel('%s-%s' % (image_dir, item_id))
+    if job is not None:
+        _remove_local_thumbs(path for path, content_type, metadata
+                             in job['files'])
+
 @observes(delete_thumbs, appendleft=True)
+@instrumented
 def s3_delete_thumbs(item):
     """Delete the thumbnails associated with the given item.
 
+    All sizes are deleted in a single multi-object delete request.
+
     :param item: A 2-tuple with a subdir name and an ID. If given a
         ORM mapped class with _thumb_dir and id attributes, the info
         can be extracted automatically.
@@ -240,15 +982,59 @@ def s3_delete_thumbs(item):
     storage = get_s3_storage()
     if not storage:
         return None
-    bucket = storage.connect_to_bucket()
+    s3_delete_keys(storage, s3_thumb_keys_for(item))
+    s3_forget_thumbs_for(item)
+    return True
+
+def s3_delete_keys(storage, paths):
+    """Delete the given keys in bulk and update the key cache to match.
 
-    for path in thumb_paths(item, exists=True).itervalues():
-        bucket.delete_key(path)
-        if bucket.get_key(path):
-            raise RuntimeError('Delete failed')
+    :raises StorageError: If any of the keys couldn't be deleted.
+    """
+    key_cache = get_s3_key_cache()
+    bucket_name = storage._data['s3_bucket_name']
+    paths = list(paths)
+    try:
+        deleted = storage.delete_paths(paths)
+    except StorageError:
+        # We can't tell which keys still exist, so forget about them all
+        for path in paths:
+            key_cache.forget(bucket_name, path)
+        raise
+    for path in deleted:
+        key_cache.set_missing(bucket_name, path)
+
+@instrumented
+def s3_delete_many(items):
+    """Delete the S3 files and thumbnails of many media items at once.
+
+    The files of every :class:`~mediacore.model.media.MediaFile` stored
+    in the S3 engine, and the thumbnails of every item, are removed with
+    as few multi-object delete requests as possible. Deleting the items
+    from the database is left to the caller.
+
+    :param items: :class:`~mediacore.model.media.Media` instances.
+    :type items: iterable
+    :returns: True, or ``None`` if no S3 engine is enabled.
+    :raises StorageError: If any of the keys couldn't be deleted.
+    """
+    storage = get_s3_storage()
+    if not storage:
+        return None
+    items = list(items)
+    paths = []
+    for item in items:
+        paths.extend(s3_thumb_keys_for(item))
+        paths.extend(storage._get_path(media_file.unique_id)
+                     for media_file in item.files
+                     if media_file.storage_id == storage.id)
+    s3_delete_keys(storage, paths)
+    for item in items:
+        s3_forget_thumbs_for(item)
     return True
 
 @observes(has_default_thumbs, appendleft=True)
+@instrumented
 def s3_has_default_thumbs(item):
     """Return True if the thumbs for the given item are the defaults.
 
@@ -261,7 +1047,19 @@ def s3_has_default_thumbs(item):
     storage = get_s3_storage()
     if not storage:
         return None
-    bucket = storage.connect_to_bucket()
     image_dir, item_id = normalize_thumb_item(item)
-    key = bucket.get_key(thumb_path(item, 's'))
-    return key and key.get_metadata('is_default_thumb') == '1'
+    if pending_thumb_items.get(image_dir, item_id):
+        # The local thumbs are the current ones until they're uploaded
+        return filecmp.cmp(
+            local_thumb_file(s3_thumb_key(image_dir, item_id, 's')),
+            local_thumb_file(s3_thumb_key(image_dir, 'new', 's')))
+    if default_thumb_items.get(image_dir, item_id):
+        return True
+    if thumb_version_items.get(image_dir, item_id):
+        # Defaults are never stored under versioned keys
+        return False
+    metadata = s3_key_metadata(storage,
+                               s3_item_thumb_key(image_dir, item_id, 's'))
+    if metadata is None:
+        return None
+    return metadata.get('is_default_thumb') == '1'
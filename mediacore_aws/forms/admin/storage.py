@@ -1,10 +1,15 @@
 # This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
 
-from mediacore.forms import ListFieldSet, TextField
+from formencode.validators import Int
+
+from mediacore.forms import (CheckBox, ListFieldSet, SingleSelectField,
+    TextArea, TextField)
 from mediacore.forms.admin.storage import StorageForm
 from mediacore.lib.i18n import N_
 from mediacore.lib.util import merge_dicts
 
+from mediacore_aws.lib.connections import get_connection_pool
+
 class AmazonS3StorageForm(StorageForm):
 
     fields = StorageForm.fields + [
@@ -16,10 +21,37 @@ class AmazonS3StorageForm(StorageForm):
                 TextField('aws_secret_key', label_text=N_('AWS Secret Key', domain='mediacore_aws')),
                 TextField('s3_bucket_name', label_text=N_('S3 Bucket Name', domain='mediacore_aws')),
                 TextField('s3_bucket_dir', label_text=N_('Subdirectory on S3 to upload to', domain='mediacore_aws')),
+                SingleSelectField('key_layout', label_text=N_('Key Layout', domain='mediacore_aws'), options=lambda: (
+                    ('flat', N_('All files under the subdirectory', domain='mediacore_aws')),
+                    ('hashed', N_('Spread across hashed prefixes', domain='mediacore_aws')),
+                ), help_text=N_('Run batch-scripts/migrate-key-layout.py to move existing files after changing this', domain='mediacore_aws')),
                 TextField('cf_download_domain', label_text=N_('Cloudfront Download Domain', domain='mediacore_aws'), help_text=N_('Optional', domain='mediacore_aws')),
                 TextField('cf_streaming_domain', label_text=N_('Cloudfront Streaming Domain', domain='mediacore_aws'), help_text=N_('Optional', domain='mediacore_aws')),
             ]
         ),
+        ListFieldSet('endpoint',
+            suppress_label=True,
+            legend=N_('Connection:', domain='mediacore_aws'),
+            children=[
+                TextField('s3_region', label_text=N_('S3 Bucket Region', domain='mediacore_aws'), help_text=N_('Detected automatically when left blank', domain='mediacore_aws')),
+                SingleSelectField('s3_endpoint', label_text=N_('S3 Endpoint', domain='mediacore_aws'), options=lambda: (
+                    ('standard', N_('Regional', domain='mediacore_aws')),
+                    ('dualstack', N_('Regional, dual-stack IPv4 and IPv6', domain='mediacore_aws')),
+                    ('accelerate', N_('Transfer Acceleration', domain='mediacore_aws')),
+                    ('accelerate-dualstack', N_('Transfer Acceleration, dual-stack IPv4 and IPv6', domain='mediacore_aws')),
+                ), help_text=N_('Transfer Acceleration must be enabled on the bucket first', domain='mediacore_aws')),
+            ]
+        ),
+        ListFieldSet('signing',
+            suppress_label=True,
+            legend=N_('Private Content:', domain='mediacore_aws'),
+            children=[
+                CheckBox('signed_urls', label_text=N_('Serve files with signed URLs', domain='mediacore_aws')),
+                TextField('signed_url_ttl', validator=Int(min=60), label_text=N_('Signed URL lifetime (seconds)', domain='mediacore_aws'), help_text=N_('URLs stay valid for between one and two lifetimes', domain='mediacore_aws')),
+                TextField('cf_key_pair_id', label_text=N_('Cloudfront Key Pair ID', domain='mediacore_aws'), help_text=N_('Required to sign Cloudfront URLs', domain='mediacore_aws')),
+                TextArea('cf_private_key', label_text=N_('Cloudfront Private Key', domain='mediacore_aws'), help_text=N_('The PEM encoded private key for the key pair', domain='mediacore_aws')),
+            ]
+        ),
     ] + StorageForm.buttons
 
     def display(self, value, **kwargs):
@@ -31,8 +63,17 @@ class AmazonS3StorageForm(StorageForm):
             'aws_secret_key': data.get('aws_secret_key', ''),
             's3_bucket_name': data.get('s3_bucket_name', ''),
             's3_bucket_dir': data.get('s3_bucket_dir', ''),
+            'key_layout': data.get('key_layout', 'flat'),
             'cf_download_domain': data.get('cf_download_domain', ''),
             'cf_streaming_domain': data.get('cf_streaming_domain', ''),
+        }, 'endpoint': {
+            's3_region': data.get('s3_region', ''),
+            's3_endpoint': data.get('s3_endpoint', 'standard'),
+        }, 'signing': {
+            'signed_urls': data.get('signed_urls', False),
+            'signed_url_ttl': data.get('signed_url_ttl', 3600),
+            'cf_key_pair_id': data.get('cf_key_pair_id', ''),
+            'cf_private_key': data.get('cf_private_key', ''),
         }}
         value = merge_dicts({}, defaults, value)
         return StorageForm.display(self, value, **kwargs)
@@ -55,9 +96,34 @@ class AmazonS3StorageForm(StorageForm):
         StorageForm.save_engine_params(self, engine, **kwargs)
         aws = kwargs['aws']
         data = engine._data
+        old_bucket_name = data.get('s3_bucket_name', u'')
+        old_region = data.get('s3_region', u'')
+        if (data['aws_access_key'], data['aws_secret_key']) != \
+                (aws['aws_access_key'], aws['aws_secret_key']) \
+                and data['s3_bucket_name']:
+            # Don't keep the old credentials' connection in the pool
+            get_connection_pool().discard(
+                data['aws_access_key'].encode('utf-8'),
+                data['aws_secret_key'].encode('utf-8'),
+                engine.s3_host)
         data['aws_access_key'] = aws['aws_access_key']
         data['aws_secret_key'] = aws['aws_secret_key']
         data['s3_bucket_name'] = aws['s3_bucket_name']
         data['s3_bucket_dir'] = aws['s3_bucket_dir']
+        data['key_layout'] = aws['key_layout']
         data['cf_download_domain'] = aws['cf_download_domain']
         data['cf_streaming_domain'] = aws['cf_streaming_domain']
+        endpoint = kwargs['endpoint']
+        data['s3_endpoint'] = endpoint['s3_endpoint']
+        region = endpoint['s3_region'].strip()
+        # The field is filled in with the saved region, so unless it was
+        # edited, a new bucket's region must be looked up again.
+        if not region or aws['s3_bucket_name'] != old_bucket_name \
+                and region == old_region:
+            region = engine.discover_region() or u''
+        data['s3_region'] = region
+        signing = kwargs['signing']
+        data['signed_urls'] = signing['signed_urls']
+        data['signed_url_ttl'] = signing['signed_url_ttl']
+        data['cf_key_pair_id'] = signing['cf_key_pair_id']
+        data['cf_private_key'] = signing['cf_private_key']
@@ -0,0 +1,134 @@
+# This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
+
+import time
+from threading import RLock
+
+__all__ = ['LRUCache', 'S3KeyCache']
+
+_missing = object()
+
+class LRUCache(object):
+    """A thread-safe, size bounded LRU cache with per-entry expiry.
+
+    Entries are kept in a circular doubly linked list so that lookups,
+    inserts and evictions are all constant time. Expired entries are
+    dropped lazily when they are next looked up, or when they reach the
+    end of the list and get evicted.
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = RLock()
+        self._map = {}
+        # Each link is a list of [prev, next, key, value, expires]
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def get(self, key, default=None):
+        """Return the cached value for key or the default if not cached."""
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is None:
+                return default
+            if link[4] < time.time():
+                self._unlink(link)
+                return default
+            # Move to the front of the list (most recently used)
+            self._unlink(link)
+            self._link_front(link)
+            return link[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        """Cache value under key for ttl seconds (default: self.ttl)."""
+        if ttl is None:
+            ttl = self.ttl
+        expires = time.time() + ttl
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+            self._link_front([None, None, key, value, expires])
+            while len(self._map) > self.max_size:
+                self._unlink(self._root[0])
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._map.clear()
+            root = self._root
+            root[:] = [root, root, None, None, None]
+        finally:
+            self._lock.release()
+
+    def _link_front(self, link):
+        root = self._root
+        first = root[1]
+        link[0] = root
+        link[1] = first
+        first[0] = root[1] = link
+        self._map[link[2]] = link
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+        del self._map[link[2]]
+
+
+class S3KeyCache(LRUCache):
+    """Cache of S3 key existence and the metadata we care about.
+
+    A cached value of ``None`` is a negative entry: the key is known not
+    to exist. Negative entries use a shorter TTL since another process
+    may create the key at any time.
+
+    Keys are namespaced by bucket name so that changing the configured
+    bucket can never return results for the old one.
+    """
+
+    def __init__(self, max_size=10000, ttl=300, negative_ttl=60):
+        LRUCache.__init__(self, max_size, ttl)
+        self.negative_ttl = negative_ttl
+
+    def lookup(self, bucket_name, path):
+        """Return a ``(hit, metadata)`` tuple for the given key.
+
+        If hit is False the key is not cached and S3 must be asked. If hit
+        is True, metadata is either a dict for an existing key or ``None``
+        if the key is known not to exist.
+        """
+        value = self.get((bucket_name, path), _missing)
+        if value is _missing:
+            return False, None
+        return True, value
+
+    def set_exists(self, bucket_name, path, metadata=None):
+        self.set((bucket_name, path), dict(metadata or {}))
+
+    def set_missing(self, bucket_name, path):
+        self.set((bucket_name, path), None, self.negative_ttl)
+
+    def forget(self, bucket_name, path):
+        self.delete((bucket_name, path))
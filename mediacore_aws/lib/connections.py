@@ -0,0 +1,136 @@
+# This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
+
+import time
+from threading import Lock
+
+from boto.s3.connection import S3Connection
+from pylons import config
+
+from mediacore_aws.lib.cache import LRUCache
+from mediacore_aws.lib.metrics import metrics, operation_name
+from mediacore_aws.lib.retry import in_retry_policy
+
+__all__ = ['InstrumentedS3Connection', 'S3ConnectionPool',
+           'get_connection_pool']
+
+class InstrumentedS3Connection(S3Connection):
+    """An S3 connection that records every request in the S3 metrics.
+
+    The latency recorded is the time until the response headers have
+    been received, and bytes received are taken from Content-Length.
+
+    Requests made for a :class:`~mediacore_aws.lib.retry.RetryPolicy`
+    call skip boto's own retries, whatever the boto config says, so that
+    each attempt is sent once and recorded once, and the policy's backoff
+    and deadlines are all that apply. Other requests keep boto's retries.
+    """
+
+    def make_request(self, method, bucket='', key='', headers=None, data='',
+                     query_args=None, sender=None, override_num_retries=None,
+                     *args, **kwargs):
+        if override_num_retries is None and in_retry_policy():
+            override_num_retries = 0
+        operation = operation_name(method, query_args)
+        key_name = getattr(key, 'name', key)
+        sent = len(data or '') \
+            or int((headers or {}).get('Content-Length', 0) or 0)
+        started = time.time()
+        try:
+            response = S3Connection.make_request(self, method, bucket, key,
+                headers, data, query_args, sender, override_num_retries,
+                *args, **kwargs)
+        except Exception:
+            metrics.record(operation, (time.time() - started) * 1000,
+                           sent, 0, True, key_name)
+            raise
+        metrics.record(operation, (time.time() - started) * 1000, sent,
+                       int(response.getheader('content-length', 0) or 0),
+                       response.status >= 400, key_name)
+        return response
+
+
+class S3ConnectionPool(object):
+    """A process-wide, thread-safe pool of S3 connections and buckets.
+
+    Connections are keyed by their credentials and endpoint host, and
+    bucket handles by those and the bucket name, so engines that share
+    settings
+    share connections, and changing an engine's settings simply starts
+    using a new entry. Entries are rebuilt once they're older than
+    ``max_age`` seconds and the least recently used entries are dropped
+    once there are more than ``max_size``.
+
+    Each boto connection keeps its own HTTP connections alive between
+    requests, so reusing them avoids a TCP and SSL handshake per request.
+    Bucket handles are created without validation, which would otherwise
+    cost an extra request every time a bucket is looked up.
+    """
+
+    connection_class = InstrumentedS3Connection
+
+    def __init__(self, max_size=32, max_age=3600):
+        # Extra keyword arguments for every new connection, for example
+        # the host and port of a local S3 stand-in for testing.
+        self.connection_kwargs = {}
+        self._connections = LRUCache(max_size, max_age)
+        self._buckets = LRUCache(max_size, max_age)
+
+    def get_connection(self, access_key, secret_key, host=None):
+        """Return a pooled connection for the given credentials.
+
+        :param host: The endpoint to connect to, or None for boto's
+            default. A host in :attr:`connection_kwargs` takes precedence.
+        """
+        cache_key = (access_key, secret_key, host)
+        conn = self._connections.get(cache_key)
+        if conn is None:
+            kwargs = {}
+            if host:
+                kwargs['host'] = host
+            kwargs.update(self.connection_kwargs)
+            conn = self.connection_class(access_key, secret_key, **kwargs)
+            self._connections.set(cache_key, conn)
+        return conn
+
+    def get_bucket(self, access_key, secret_key, bucket_name, host=None):
+        """Return a pooled, unvalidated bucket handle."""
+        conn = self.get_connection(access_key, secret_key, host)
+        cache_key = (access_key, secret_key, host, bucket_name)
+        bucket = self._buckets.get(cache_key)
+        # Rebuild the handle if the connection it used has been replaced
+        if bucket is None or bucket.connection is not conn:
+            bucket = conn.get_bucket(bucket_name, validate=False)
+            self._buckets.set(cache_key, bucket)
+        return bucket
+
+    def discard(self, access_key, secret_key, host=None):
+        """Drop the pooled connection for the given credentials and host.
+
+        The next request for it, or for any of its buckets, will build a
+        new one. This should be called when a connection is suspected to
+        be broken or the credentials are no longer in use.
+        """
+        self._connections.delete((access_key, secret_key, host))
+
+    def clear(self):
+        self._connections.clear()
+        self._buckets.clear()
+
+
+_pool = None
+_pool_lock = Lock()
+
+def get_connection_pool():
+    """Return the process-wide connection pool, creating it if need be."""
+    global _pool
+    if _pool is None:
+        _pool_lock.acquire()
+        try:
+            if _pool is None:
+                _pool = S3ConnectionPool(
+                    max_size=int(config.get('s3.connection_pool_size', 32)),
+                    max_age=int(config.get('s3.connection_max_age', 3600)),
+                )
+        finally:
+            _pool_lock.release()
+    return _pool
@@ -0,0 +1,277 @@
+# This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
+
+import errno
+import logging
+import os
+import time
+from hashlib import sha1
+from thread import get_ident
+from threading import Event, Lock
+
+import simplejson
+from boto.exception import S3ResponseError
+from boto.s3.key import Key
+from pylons import config
+
+from mediacore.lib.storage import StorageError
+
+from mediacore_aws.lib.retry import get_retry_policy
+from mediacore_aws.lib.workers import ThreadPool
+
+__all__ = ['S3DiskCache', 'get_disk_cache']
+
+log = logging.getLogger(__name__)
+
+class _Fetch(object):
+    """A download in progress, for other threads to wait on."""
+
+    def __init__(self):
+        self.done = Event()
+        self.path = None
+
+
+class S3DiskCache(object):
+    """A size-capped cache of S3 objects on the local disk.
+
+    Each object is kept as a ``.data`` file, with its ETag in a ``.meta``
+    file beside it, named after a hash of the bucket and key. The ETag is
+    checked with a HEAD request each time the object is asked for, so a
+    changed object is never served from the cache.
+
+    Large objects are downloaded in ranges, in parallel. Threads that ask
+    for an object while it's being downloaded wait for that download
+    rather than starting their own.
+
+    Once the cache grows past ``max_bytes`` the least recently used files
+    are removed. Files used in the last ``grace`` seconds are never
+    removed, so that callers can rely on a path they've been given for at
+    least that long. The cache can briefly grow larger as a result.
+    """
+
+    def __init__(self, root, max_bytes, range_size=8 * 1024 * 1024,
+                 ranged_threshold=32 * 1024 * 1024, max_workers=4,
+                 grace=3600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.range_size = range_size
+        self.ranged_threshold = ranged_threshold
+        self.max_workers = max_workers
+        self.grace = grace
+        self._lock = Lock()
+        self._fetches = {}
+
+    def _entry_path(self, bucket_name, key_name):
+        digest = sha1('%s/%s' % (bucket_name, key_name)).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get_path(self, bucket, key_name):
+        """Return the path of an up to date local copy of the given key.
+
+        :raises StorageError: If the key doesn't exist or can't be
+            downloaded.
+        """
+        entry_path = self._entry_path(bucket.name, key_name)
+        while True:
+            self._lock.acquire()
+            try:
+                fetch = self._fetches.get(entry_path)
+                leader = fetch is None
+                if leader:
+                    fetch = self._fetches[entry_path] = _Fetch()
+            finally:
+                self._lock.release()
+
+            if not leader:
+                fetch.done.wait()
+                if fetch.path is not None:
+                    return fetch.path
+                # The download failed, so try it ourselves
+                continue
+
+            try:
+                fetch.path = self._get_path(bucket, key_name, entry_path)
+                return fetch.path
+            finally:
+                self._lock.acquire()
+                try:
+                    del self._fetches[entry_path]
+                finally:
+                    self._lock.release()
+                fetch.done.set()
+
+    def _get_path(self, bucket, key_name, entry_path):
+        data_path = entry_path + '.data'
+        try:
+            key = get_retry_policy('read').call(bucket.get_key, key_name)
+        except S3ResponseError, e:
+            raise StorageError('Failed to look up %s in S3: %s' % (key_name, e))
+        if key is None:
+            raise StorageError('%s does not exist in S3.' % key_name)
+        etag = key.etag.strip('"')
+        size = int(key.size)
+
+        meta = self._read_meta(entry_path)
+        if meta and meta['etag'] == etag and os.path.exists(data_path):
+            self._touch(data_path)
+            return data_path
+
+        dirname = os.path.dirname(entry_path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        tmp_path = '%s.%d.%d.tmp' % (entry_path, os.getpid(), get_ident())
+        try:
+            if size >= self.ranged_threshold:
+                self._download_ranges(bucket, key_name, etag, size, tmp_path)
+            else:
+                self._download(key, tmp_path)
+            if os.path.getsize(tmp_path) != size:
+                raise StorageError('Downloaded %s incompletely.' % key_name)
+            os.rename(tmp_path, data_path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._write_meta(entry_path, {'bucket': bucket.name, 'key': key_name,
+                                      'etag': etag, 'size': size})
+        self.evict()
+        return data_path
+
+    def _download(self, key, path):
+        f = open(path, 'wb')
+        try:
+            try:
+                key.get_contents_to_file(f)
+            except S3ResponseError, e:
+                raise StorageError('Failed to download %s from S3: %s'
+                                   % (key.name, e))
+        finally:
+            f.close()
+
+    def _download_ranges(self, bucket, key_name, etag, size, path):
+        """Download the key in ranges, each written at its own offset."""
+        f = open(path, 'wb')
+        try:
+            f.truncate(size)
+        finally:
+            f.close()
+
+        def fetch_range(start, end):
+            key = Key(bucket)
+            key.key = key_name
+            # If-Match makes sure every range comes from the same version
+            headers = {'Range': 'bytes=%d-%d' % (start, end),
+                       'If-Match': '"%s"' % etag}
+            f = open(path, 'r+b')
+            try:
+                f.seek(start)
+                try:
+                    key.get_contents_to_file(f, headers)
+                except S3ResponseError, e:
+                    raise StorageError('Failed to download bytes %d-%d of %s '
+                                       'from S3: %s' % (start, end, key_name, e))
+            finally:
+                f.close()
+
+        pool = ThreadPool(self.max_workers, max_pending=self.max_workers)
+        try:
+            for start in xrange(0, size, self.range_size):
+                pool.submit(fetch_range, start,
+                            min(start + self.range_size, size) - 1)
+        finally:
+            pool.join()
+
+    def _read_meta(self, entry_path):
+        try:
+            f = open(entry_path + '.meta')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            try:
+                return simplejson.load(f)
+            except ValueError:
+                return None
+        finally:
+            f.close()
+
+    def _write_meta(self, entry_path, meta):
+        tmp_path = '%s.meta.%d.%d.tmp' % (entry_path, os.getpid(), get_ident())
+        f = open(tmp_path, 'w')
+        try:
+            simplejson.dump(meta, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, entry_path + '.meta')
+
+    def _touch(self, path):
+        # Access times aren't reliable, so the mtime records the last use
+        try:
+            os.utime(path, None)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def evict(self):
+        """Remove the least recently used files until we're under size."""
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith('.data'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        if total <= self.max_bytes:
+            return
+        cutoff = time.time() - self.grace
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes or mtime > cutoff:
+                break
+            entry_path = path[:-len('.data')]
+            for filename in (path, entry_path + '.meta'):
+                try:
+                    os.remove(filename)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            total -= size
+        if total > self.max_bytes:
+            log.warning('The local S3 file cache is %d MB, over its limit of '
+                        '%d MB, because all its files were recently used.',
+                        total / 1048576, self.max_bytes / 1048576)
+
+_cache = None
+_cache_lock = Lock()
+
+def get_disk_cache():
+    """Return the process-wide local cache of S3 files, creating it if
+    need be."""
+    global _cache
+    if _cache is None:
+        _cache_lock.acquire()
+        try:
+            if _cache is None:
+                _cache = S3DiskCache(
+                    root=config.get('s3.local_cache_dir') or os.path.join(
+                        config['cache.dir'], 's3', 'files'),
+                    max_bytes=int(config.get('s3.local_cache_mb', 10240))
+                        * 1024 * 1024,
+                    range_size=int(config.get('s3.local_cache_range_mb', 8))
+                        * 1024 * 1024,
+                    max_workers=int(config.get('s3.local_cache_threads', 4)),
+                    grace=int(config.get('s3.local_cache_grace', 3600)),
+                )
+        finally:
+            _cache_lock.release()
+    return _cache
@@ -0,0 +1,92 @@
+# This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
+
+import time
+from threading import Lock
+
+from pylons import config
+
+__all__ = ['EngineCache', 'invalidate_s3_storage', 's3_engine_cache']
+
+_missing = object()
+
+class EngineCache(object):
+    """A process-wide cache for a single value that's costly to load.
+
+    This is used to hold the enabled S3 storage engine so that it doesn't
+    need to be queried on every request, and so that batch scripts and
+    background threads, which have no request context, are cached too.
+
+    Changes made in this process call :meth:`invalidate`. Changes made by
+    other processes are picked up once the value is ``ttl`` seconds old.
+    """
+
+    def __init__(self, ttl=None):
+        self._ttl = ttl
+        self._lock = Lock()
+        self._value = _missing
+        self._expires = 0
+        self._generation = 0
+
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            return int(config.get('s3.engine_cache_ttl', 60))
+        return self._ttl
+
+    def get(self, loader):
+        """Return the cached value, calling ``loader()`` if it has expired."""
+        self._lock.acquire()
+        try:
+            if self._value is not _missing and self._expires > time.time():
+                return self._value
+            generation = self._generation
+        finally:
+            self._lock.release()
+
+        # Load without holding the lock so a slow query can't block
+        # threads that are only invalidating.
+        value = loader()
+
+        self._lock.acquire()
+        try:
+            # Don't cache a value that was loaded from before an invalidation
+            if generation == self._generation:
+                self._value = value
+                self._expires = time.time() + self.ttl
+        finally:
+            self._lock.release()
+        return value
+
+    def set(self, value, ttl=None):
+        """Cache the given value, for callers that load it themselves.
+
+        :param ttl: How long to keep it for, in seconds, if not for the
+            usual ``ttl``.
+        """
+        self._lock.acquire()
+        try:
+            self._value = value
+            self._expires = time.time() + (ttl is None and self.ttl or ttl)
+            self._generation += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """Discard the cached value so that the next get reloads it."""
+        self._lock.acquire()
+        try:
+            self._value = _missing
+            self._generation += 1
+        finally:
+            self._lock.release()
+
+
+# Holds a (storage engine, bucket url) tuple for the enabled S3 engine.
+s3_engine_cache = EngineCache()
+
+def invalidate_s3_storage(*args, **kwargs):
+    """Discard the cached S3 engine, e.g. after its settings have changed.
+
+    Any arguments are ignored so this can be used as an event listener.
+    """
+    s3_engine_cache.invalidate()
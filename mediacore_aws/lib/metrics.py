@@ -0,0 +1,302 @@
+# This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
+
+import logging
+import socket
+from functools import wraps
+from threading import Lock, local
+
+from pylons import config
+
+__all__ = [
+    'LATENCY_BUCKETS',
+    'S3Metrics',
+    'S3MetricsMiddleware',
+    'StatsdSink',
+    'instrumented',
+    'metrics',
+    'operation_name',
+]
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Query string sub-resources that identify a distinct kind of request
+_subresources = frozenset(['delete', 'location', 'partNumber', 'uploadId',
+                           'uploads'])
+
+def operation_name(method, query_args=None):
+    """Return a short name for the kind of S3 request being made.
+
+    Plain object requests are named by their HTTP verb. Requests on a
+    sub-resource are named after it too, e.g. ``POST delete`` for a
+    multi-object delete. ACL changes are simply ``ACL``.
+    """
+    if query_args:
+        name = query_args.split('&', 1)[0].split('=', 1)[0]
+        if name == 'acl':
+            return 'ACL'
+        if name in _subresources:
+            return '%s %s' % (method, name)
+    return method
+
+
+class OperationStats(object):
+    """Counters for one kind of request made from one hook."""
+
+    __slots__ = ('count', 'errors', 'bytes_sent', 'bytes_received',
+                 'total_ms', 'buckets')
+
+    def __init__(self):
+        self.count = self.errors = 0
+        self.bytes_sent = self.bytes_received = 0
+        self.total_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, elapsed_ms, sent, received, error):
+        self.count += 1
+        self.errors += int(bool(error))
+        self.bytes_sent += sent
+        self.bytes_received += received
+        self.total_ms += elapsed_ms
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed_ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'total_ms': self.total_ms,
+            'buckets': list(self.buckets),
+        }
+
+
+class S3Metrics(object):
+    """Process-wide and per-request statistics for S3 requests.
+
+    Requests are recorded by
+    :class:`mediacore_aws.lib.connections.InstrumentedS3Connection` and
+    attributed to the outermost :func:`instrumented` hook or engine
+    method that is running in the current thread. Tasks run by
+    :class:`mediacore_aws.lib.workers.ThreadPool` inherit the context of
+    the thread that submitted them.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._stats = {}
+        self._counters = {}
+        self._local = local()
+
+    # Thread context
+
+    def get_context(self):
+        """Return the current thread's (hook, request stats) for handing
+        over to another thread."""
+        return (getattr(self._local, 'hook', None),
+                getattr(self._local, 'request', None))
+
+    def set_context(self, context):
+        self._local.hook, self._local.request = context
+
+    @property
+    def current_hook(self):
+        return getattr(self._local, 'hook', None)
+
+    def enter_hook(self, name):
+        """Attribute requests to the given hook until :meth:`exit_hook`.
+
+        :returns: True if this is the outermost hook, which must be passed
+            to :meth:`exit_hook`.
+        """
+        if getattr(self._local, 'hook', None) is None:
+            self._local.hook = name
+            return True
+        return False
+
+    def exit_hook(self, outermost):
+        if outermost:
+            self._local.hook = None
+
+    # Per-request summaries
+
+    def start_request(self):
+        """Start collecting a summary of the requests made by this thread."""
+        self._local.request = {}
+
+    def request_summary(self):
+        """Return and stop collecting the current request's summary.
+
+        :returns: A dict of ``(hook, operation)`` keys and
+            :class:`OperationStats` values, or None if no summary was
+            being collected.
+        """
+        summary = getattr(self._local, 'request', None)
+        self._local.request = None
+        return summary
+
+    # Recording
+
+    def record(self, operation, elapsed_ms, sent=0, received=0, error=False,
+               key_name=None):
+        """Record one S3 request made by the current thread."""
+        hook = getattr(self._local, 'hook', None) or 'other'
+        stat_key = (hook, operation)
+        self._lock.acquire()
+        try:
+            stats = self._stats.get(stat_key)
+            if stats is None:
+                stats = self._stats[stat_key] = OperationStats()
+            stats.add(elapsed_ms, sent, received, error)
+            request = getattr(self._local, 'request', None)
+            if request is not None:
+                stats = request.get(stat_key)
+                if stats is None:
+                    stats = request[stat_key] = OperationStats()
+                stats.add(elapsed_ms, sent, received, error)
+        finally:
+            self._lock.release()
+
+        threshold = float(config.get('s3.slow_call_ms', 0) or 0)
+        if threshold and elapsed_ms >= threshold:
+            log.warning('Slow S3 request: %s %s took %dms in %s',
+                        operation, key_name or '-', elapsed_ms, hook)
+
+    def incr(self, name, count=1):
+        """Add to a named process-wide counter, e.g. ``retry.read.retries``."""
+        self._lock.acquire()
+        try:
+            self._counters[name] = self._counters.get(name, 0) + count
+        finally:
+            self._lock.release()
+
+    def counters(self):
+        """Return a copy of the named counters."""
+        self._lock.acquire()
+        try:
+            return dict(self._counters)
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Return a copy of the process-wide statistics.
+
+        :returns: A dict of ``(hook, operation)`` keys and dicts of
+            counters, see :meth:`OperationStats.as_dict`.
+        """
+        self._lock.acquire()
+        try:
+            return dict((key, stats.as_dict())
+                        for key, stats in self._stats.iteritems())
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._stats.clear()
+            self._counters.clear()
+        finally:
+            self._lock.release()
+
+metrics = S3Metrics()
+
+
+def instrumented(func):
+    """Attribute the S3 requests made by the decorated function to it."""
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        outermost = metrics.enter_hook(name)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.exit_hook(outermost)
+    return wrapper
+
+
+def format_summary(summary):
+    """Format a per-request summary as a single log line."""
+    parts = []
+    for (hook, operation), stats in sorted(summary.iteritems()):
+        parts.append('%s %s x%d %dms %dB' % (
+            hook, operation, stats.count, stats.total_ms,
+            stats.bytes_sent + stats.bytes_received))
+    total = sum(stats.total_ms for stats in summary.itervalues())
+    count = sum(stats.count for stats in summary.itervalues())
+    return '%d S3 requests in %dms: %s' % (count, total, ', '.join(parts))
+
+
+class S3MetricsMiddleware(object):
+    """WSGI middleware that logs a summary of each request's S3 usage.
+
+    Requests that made no S3 requests aren't logged.
+    """
+
+    def __init__(self, app, level=logging.INFO):
+        self.app = app
+        self.level = level
+
+    def __call__(self, environ, start_response):
+        metrics.start_request()
+        try:
+            return self.app(environ, start_response)
+        finally:
+            summary = metrics.request_summary()
+            if summary:
+                log.log(self.level, '%s %s: %s', environ.get('REQUEST_METHOD'),
+                        environ.get('PATH_INFO'), format_summary(summary))
+
+
+class StatsdSink(object):
+    """Send the process-wide S3 statistics to a StatsD server.
+
+    Each call to :meth:`flush` sends the counters that have changed since
+    the last call, named ``<prefix>.<hook>.<operation>.<counter>``, and
+    the named counters from :meth:`S3Metrics.incr` as ``<prefix>.<name>``.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='mediacore.s3'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._last = {}
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def flush(self):
+        lines = []
+        for (hook, operation), stats in metrics.snapshot().iteritems():
+            name = '%s.%s.%s' % (self.prefix, hook,
+                                 operation.replace(' ', '_'))
+            values = dict((counter, stats[counter]) for counter in
+                          ('count', 'errors', 'bytes_sent', 'bytes_received'))
+            for i, count in enumerate(stats['buckets']):
+                if i < len(LATENCY_BUCKETS):
+                    values['latency_le_%d' % LATENCY_BUCKETS[i]] = count
+                else:
+                    values['latency_gt_%d' % LATENCY_BUCKETS[-1]] = count
+            for counter, value in values.iteritems():
+                metric = '%s.%s' % (name, counter)
+                delta = value - self._last.get(metric, 0)
+                self._last[metric] = value
+                if delta:
+                    lines.append('%s:%d|c' % (metric, delta))
+        for counter, value in metrics.counters().iteritems():
+            metric = '%s.%s' % (self.prefix, counter)
+            delta = value - self._last.get(metric, 0)
+            self._last[metric] = value
+            if delta:
+                lines.append('%s:%d|c' % (metric, delta))
+        for line in lines:
+            try:
+                self._socket.sendto(line, self.address)
+            except socket.error:
+                log.exception('Failed to send S3 metrics to StatsD')
+                return
@@ -0,0 +1,219 @@
+# This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
+
+import logging
+from cStringIO import StringIO
+from hashlib import md5
+
+from boto.exception import S3ResponseError
+from boto.s3.multipart import MultiPartUpload
+
+from mediacore.lib.storage import StorageError
+
+from mediacore_aws.lib.workers import ThreadPool
+
+__all__ = [
+    'MultipartUploadError',
+    'MultipartUploader',
+    'choose_part_size',
+    'copy_in_parts',
+    'iter_parts',
+    'open_upload',
+]
+
+log = logging.getLogger(__name__)
+
+# S3 rejects parts smaller than this, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+# S3 allows at most this many parts per upload
+MAX_PARTS = 10000
+# S3 copies objects up to this size in a single request
+MAX_COPY_SIZE = 5 * 1024 * 1024 * 1024
+
+class MultipartUploadError(StorageError):
+    """Raised when a multipart upload fails.
+
+    :attr upload_id: The ID of the failed upload if it was left open so
+        that it can be resumed, otherwise ``None``.
+    """
+    def __init__(self, msg, upload_id=None):
+        StorageError.__init__(self, msg)
+        self.upload_id = upload_id
+
+
+def open_upload(bucket, key_name, upload_id):
+    """Return a boto handle for an existing multipart upload.
+
+    Iterating over it lists the parts that have been uploaded so far.
+    """
+    mp = MultiPartUpload(bucket)
+    mp.key_name = key_name
+    mp.id = upload_id
+    return mp
+
+def choose_part_size(total_size, part_size):
+    """Return the part size to upload ``total_size`` bytes with.
+
+    This is ``part_size`` unless that would take more than
+    :data:`MAX_PARTS` parts, and never less than :data:`MIN_PART_SIZE`.
+    """
+    needed = -(-total_size // MAX_PARTS)
+    return max(part_size, needed, MIN_PART_SIZE)
+
+def copy_in_parts(bucket, src_key, dst_key_name, policy=None,
+                  part_size=512 * 1024 * 1024, max_workers=4):
+    """Copy a key within the bucket with a multipart upload.
+
+    This is needed for objects over :data:`MAX_COPY_SIZE`. Each part is
+    copied by S3 from a range of the source, so no data passes through
+    us. The content type, cache control and user metadata are kept.
+
+    :param src_key: The source key, as returned by ``bucket.get_key``.
+    :raises MultipartUploadError: If the copy fails. The upload is
+        aborted.
+    """
+    headers = {}
+    if src_key.content_type:
+        headers['Content-Type'] = src_key.content_type
+    if src_key.cache_control:
+        headers['Cache-Control'] = src_key.cache_control
+    mp = bucket.initiate_multipart_upload(dst_key_name, headers=headers,
+        metadata=src_key.metadata, policy=policy)
+    size = int(src_key.size)
+    part_size = choose_part_size(size, part_size)
+    pool = ThreadPool(max_workers, max_pending=max_workers)
+    try:
+        try:
+            for part_num, start in enumerate(xrange(0, size, part_size)):
+                pool.submit(mp.copy_part_from_key, bucket.name, src_key.name,
+                            part_num + 1, start,
+                            min(start + part_size, size) - 1)
+        finally:
+            pool.join()
+        mp.complete_upload()
+    except Exception, e:
+        log.exception('Multipart copy of %s failed', src_key.name)
+        try:
+            mp.cancel_upload()
+        except S3ResponseError:
+            log.exception('Failed to abort upload %s', mp.id)
+        raise MultipartUploadError('Copy of %s to %s failed: %s'
+                                   % (src_key.name, dst_key_name, e))
+
+def iter_parts(source, part_size):
+    """Yield the data from the source in strings of exactly ``part_size``.
+
+    The last string may be shorter. The source can be a file-like object
+    with a ``read`` method or an iterable of strings of any length.
+    """
+    if hasattr(source, 'read'):
+        while True:
+            data = source.read(part_size)
+            # Pipes and sockets may return less than was asked for
+            while data and len(data) < part_size:
+                more = source.read(part_size - len(data))
+                if not more:
+                    break
+                data += more
+            if not data:
+                return
+            yield data
+    buf = []
+    buf_size = 0
+    for chunk in source:
+        buf.append(chunk)
+        buf_size += len(chunk)
+        if buf_size >= part_size:
+            data = ''.join(buf)
+            for offset in xrange(0, len(data) - part_size + 1, part_size):
+                yield data[offset:offset + part_size]
+            remainder = data[offset + part_size:]
+            buf = [remainder]
+            buf_size = len(remainder)
+    if buf_size:
+        yield ''.join(buf)
+
+
+class MultipartUploader(object):
+    """Stream data into an S3 key using a multipart upload.
+
+    Parts are uploaded in parallel by ``max_workers`` threads. Reading
+    from the source blocks while ``max_workers`` parts are waiting to be
+    uploaded, so no more than ``2 * max_workers`` parts are ever held in
+    memory at once.
+
+    An interrupted upload can be resumed by passing its ID to
+    :meth:`upload`. Parts that S3 already has with a matching MD5 are not
+    sent again.
+    """
+
+    def __init__(self, bucket, key_name, headers=None, policy=None,
+                 part_size=16 * 1024 * 1024, max_workers=4):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError('S3 multipart uploads require parts of at '
+                             'least %d bytes' % MIN_PART_SIZE)
+        self.bucket = bucket
+        self.key_name = key_name
+        self.headers = headers
+        self.policy = policy
+        self.part_size = part_size
+        self.max_workers = max_workers
+
+    def upload(self, source, upload_id=None, abort_on_failure=True):
+        """Upload everything in the source and complete the upload.
+
+        :param source: A file-like object or an iterable of strings.
+        :param upload_id: The ID of an earlier, incomplete upload of the
+            same data to the same key, to resume instead of starting over.
+        :param abort_on_failure: If False, a failed upload is left open so
+            that it can be resumed later, instead of being aborted.
+        :returns: The total number of bytes in the uploaded object.
+        :raises MultipartUploadError: If the upload fails.
+        """
+        if upload_id:
+            mp = self._resume(upload_id)
+            uploaded = dict((part.part_number, part.etag) for part in mp)
+        else:
+            mp = self.bucket.initiate_multipart_upload(self.key_name,
+                headers=self.headers, policy=self.policy)
+            uploaded = {}
+
+        pool = ThreadPool(self.max_workers, max_pending=self.max_workers)
+        size = 0
+        part_num = 0
+        try:
+            try:
+                for data in iter_parts(source, self.part_size):
+                    part_num += 1
+                    if part_num > MAX_PARTS:
+                        raise MultipartUploadError('Too many parts, use a '
+                                                   'larger part size')
+                    size += len(data)
+                    etag = '"%s"' % md5(data).hexdigest()
+                    if uploaded.get(part_num) == etag:
+                        continue
+                    pool.submit(self._upload_part, mp, part_num, data)
+                if not part_num:
+                    # S3 won't complete an upload with no parts
+                    part_num = 1
+                    pool.submit(self._upload_part, mp, part_num, '')
+            finally:
+                pool.join()
+            mp.complete_upload()
+        except Exception, e:
+            log.exception('Multipart upload of %s failed', self.key_name)
+            if abort_on_failure:
+                try:
+                    mp.cancel_upload()
+                except S3ResponseError:
+                    log.exception('Failed to abort upload %s', mp.id)
+                raise MultipartUploadError('Upload of %s to S3 failed: %s'
+                                           % (self.key_name, e))
+            raise MultipartUploadError('Upload of %s to S3 failed: %s'
+                                       % (self.key_name, e), mp.id)
+        return size
+
+    def _resume(self, upload_id):
+        return open_upload(self.bucket, self.key_name, upload_id)
+
+    def _upload_part(self, mp, part_num, data):
+        mp.upload_part_from_file(StringIO(data), part_num)
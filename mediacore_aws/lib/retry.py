@@ -0,0 +1,301 @@
+# This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
+
+import httplib
+import logging
+import random
+import socket
+import sys
+import time
+from collections import deque
+from threading import Event, Lock, Thread, local
+
+from boto.exception import BotoServerError
+from paste.deploy.converters import asbool
+from pylons import config
+
+from mediacore.lib.storage import StorageError
+
+from mediacore_aws.lib.metrics import metrics
+
+__all__ = [
+    'DeadlineExceeded',
+    'LatencyTracker',
+    'RetryPolicy',
+    'get_retry_policy',
+    'in_retry_policy',
+    'is_retryable',
+]
+
+log = logging.getLogger(__name__)
+
+# Server errors that S3 asks clients to retry
+RETRYABLE_STATUSES = frozenset([500, 502, 503, 504])
+
+def is_retryable(error):
+    """Return True if the request that raised the error may succeed if
+    it's simply sent again."""
+    if isinstance(error, BotoServerError):
+        return error.status in RETRYABLE_STATUSES
+    return isinstance(error, (socket.error, httplib.HTTPException))
+
+
+_local = local()
+
+def in_retry_policy():
+    """Return True if the current thread is running an attempt of a
+    :class:`RetryPolicy` call, which retries it as need be."""
+    return getattr(_local, 'depth', 0) > 0
+
+def _attempt(func, args, kwargs):
+    _local.depth = getattr(_local, 'depth', 0) + 1
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _local.depth -= 1
+
+
+class DeadlineExceeded(StorageError):
+    """Raised when a call didn't succeed within its deadline.
+
+    The request that was in flight is left to finish in the background.
+    """
+
+
+class LatencyTracker(object):
+    """Tracks a percentile of recent latencies, in seconds."""
+
+    def __init__(self, size=200, percentile=0.95, min_samples=20):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=size)
+        self._lock = Lock()
+        self._value = None
+        self._stale = 0
+
+    def add(self, elapsed):
+        self._lock.acquire()
+        try:
+            self._samples.append(elapsed)
+            self._stale += 1
+        finally:
+            self._lock.release()
+
+    def value(self):
+        """Return the percentile, or None until there are enough samples.
+
+        The samples are only re-sorted every tenth of the window.
+        """
+        self._lock.acquire()
+        try:
+            if len(self._samples) < self.min_samples:
+                return None
+            if self._value is None \
+                    or self._stale * 10 >= self._samples.maxlen:
+                ordered = sorted(self._samples)
+                self._value = ordered[int(len(ordered) * self.percentile)]
+                self._stale = 0
+            return self._value
+        finally:
+            self._lock.release()
+
+
+class _HedgedCall(object):
+    """The attempts at one hedged call, each run in its own thread."""
+
+    def __init__(self, policy, func, args, kwargs):
+        self.policy = policy
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.context = metrics.get_context()
+        self.done = Event()
+        self._lock = Lock()
+        self.started = 0
+        self.failed = 0
+        self.winner = None
+        self.result = None
+        self.exc_info = None
+
+    def start(self):
+        self._lock.acquire()
+        try:
+            attempt = self.started
+            self.started += 1
+        finally:
+            self._lock.release()
+        thread = Thread(target=self._run, args=(attempt,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run(self, attempt):
+        metrics.set_context(self.context)
+        started = time.time()
+        try:
+            result = _attempt(self.func, self.args, self.kwargs)
+        except Exception:
+            self._lock.acquire()
+            try:
+                self.failed += 1
+                self.exc_info = sys.exc_info()
+                # Only give up once every attempt has failed
+                if self.failed == self.started and self.winner is None:
+                    self.done.set()
+            finally:
+                self._lock.release()
+            return
+        self.policy.latency.add(time.time() - started)
+        self._lock.acquire()
+        try:
+            if self.winner is None:
+                self.winner = attempt
+                self.result = result
+                self.done.set()
+        finally:
+            self._lock.release()
+
+    def get(self):
+        if self.winner is None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class RetryPolicy(object):
+    """Retries S3 calls that fail with a transient error.
+
+    Retries wait for a random delay of up to ``base_delay * 2 ** n``
+    seconds, capped at ``max_delay`` ("full jitter"), so that clients
+    that failed together don't retry together. No retry is started that
+    would end past the ``deadline``, in seconds.
+
+    If ``hedge`` is enabled, which must only be done for idempotent
+    reads, each attempt is run in a thread and a second, identical
+    request is sent if the first hasn't returned after ``hedge_after``
+    seconds. Whichever returns first is used. By default the threshold
+    is the 95th percentile of recent latencies. Hedged calls raise
+    :class:`DeadlineExceeded` as soon as the deadline passes, rather than
+    waiting for the socket to time out.
+
+    Counters for attempts, retries, failures, hedges, hedges that won and
+    deadlines exceeded are kept as ``retry.<name>.*`` in
+    :data:`mediacore_aws.lib.metrics.metrics`.
+    """
+
+    def __init__(self, name, attempts=3, base_delay=0.05, max_delay=1.0,
+                 deadline=None, hedge=False, hedge_after=None,
+                 min_hedge_after=0.02):
+        self.name = name
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_after = hedge_after
+        self.min_hedge_after = min_hedge_after
+        self.latency = LatencyTracker()
+
+    def _incr(self, counter):
+        metrics.incr('retry.%s.%s' % (self.name, counter))
+
+    def hedge_threshold(self):
+        """Return the seconds to wait before hedging, or None to not."""
+        if self.hedge_after:
+            return self.hedge_after
+        p95 = self.latency.value()
+        if p95 is None:
+            return None
+        return max(p95, self.min_hedge_after)
+
+    def call(self, func, *args, **kwargs):
+        """Call ``func`` with the given arguments, retrying as needed.
+
+        :raises DeadlineExceeded: If the deadline passed first.
+        :raises: The last error if it isn't retryable or we're out of
+            attempts.
+        """
+        deadline_at = self.deadline and time.time() + self.deadline
+        for attempt in xrange(self.attempts):
+            self._incr('attempts')
+            if attempt:
+                self._incr('retries')
+            try:
+                if self.hedge:
+                    return self._call_hedged(func, args, kwargs, deadline_at)
+                return _attempt(func, args, kwargs)
+            except DeadlineExceeded:
+                raise
+            except Exception, e:
+                if not is_retryable(e):
+                    raise
+                if attempt + 1 == self.attempts:
+                    self._incr('failures')
+                    raise
+                delay = random.uniform(
+                    0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if deadline_at and time.time() + delay >= deadline_at:
+                    self._incr('deadlines')
+                    raise DeadlineExceeded('S3 call %s did not succeed '
+                                           'within its deadline: %s'
+                                           % (self.name, e))
+                log.debug('Retrying S3 call %s in %.3fs after: %s',
+                          self.name, delay, e)
+                time.sleep(delay)
+
+    def _call_hedged(self, func, args, kwargs, deadline_at):
+        call = _HedgedCall(self, func, args, kwargs)
+        call.start()
+        threshold = self.hedge_threshold()
+        if threshold is not None:
+            if deadline_at:
+                threshold = min(threshold, max(0, deadline_at - time.time()))
+            call.done.wait(threshold)
+            if not call.done.isSet() \
+                    and (not deadline_at or time.time() < deadline_at):
+                self._incr('hedges')
+                call.start()
+        if deadline_at:
+            call.done.wait(max(0, deadline_at - time.time()))
+        else:
+            call.done.wait()
+        if not call.done.isSet():
+            self._incr('deadlines')
+            raise DeadlineExceeded('S3 call %s took longer than %.1fs'
+                                   % (self.name, self.deadline))
+        if call.winner:
+            self._incr('hedge_wins')
+        return call.get()
+
+
+_policies = {}
+_policies_lock = Lock()
+
+def get_retry_policy(kind):
+    """Return the process-wide retry policy for ``read`` or ``write`` calls.
+
+    Reads are hedged and have a deadline of ``s3.read_deadline_ms``.
+    Writes are only retried, within ``s3.write_deadline_ms`` if that's
+    set. The other settings are shared: ``s3.retry_attempts``,
+    ``s3.retry_base_ms``, ``s3.retry_max_ms`` and, for reads,
+    ``s3.hedge_reads`` and ``s3.hedge_after_ms``.
+    """
+    policy = _policies.get(kind)
+    if policy is None:
+        _policies_lock.acquire()
+        try:
+            policy = _policies.get(kind)
+            if policy is None:
+                read = kind == 'read'
+                deadline_ms = int(config.get('s3.%s_deadline_ms' % kind,
+                                             read and 3000 or 0))
+                policy = _policies[kind] = RetryPolicy(
+                    kind,
+                    attempts=int(config.get('s3.retry_attempts', 3)),
+                    base_delay=int(config.get('s3.retry_base_ms', 50)) / 1000.0,
+                    max_delay=int(config.get('s3.retry_max_ms', 1000)) / 1000.0,
+                    deadline=deadline_ms and deadline_ms / 1000.0 or None,
+                    hedge=read and asbool(config.get('s3.hedge_reads', True)),
+                    hedge_after=int(config.get('s3.hedge_after_ms', 0))
+                        / 1000.0 or None,
+                )
+        finally:
+            _policies_lock.release()
+    return policy
@@ -0,0 +1,95 @@
+# This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
+
+import hmac
+import time
+
+from base64 import b64encode
+from urllib import quote
+
+from mediacore.lib.compat import sha1
+from mediacore.lib.storage import StorageError
+
+from mediacore_aws.lib.cache import LRUCache
+
+try:
+    import rsa
+except ImportError:
+    rsa = None
+
+__all__ = [
+    'cloudfront_query_auth',
+    'quantized_expiry',
+    's3_query_auth',
+    'signature_cache',
+]
+
+# Signed query strings, keyed by everything that went into signing them.
+# Entries are given a TTL that matches the time until they expire.
+signature_cache = LRUCache(max_size=20000)
+
+def quantized_expiry(window, now=None):
+    """Return an expiry time that only changes once every ``window`` seconds.
+
+    The expiry falls at the end of the window after the current one, so a
+    URL signed with it is always valid for between one and two windows.
+    Every URL signed for the same file within a window is then identical,
+    so browsers and CDNs can cache the response.
+    """
+    if now is None:
+        now = time.time()
+    return (int(now) // window + 2) * window
+
+def s3_query_auth(access_key, secret_key, bucket_name, path, expires,
+                  method='GET', subresource=None):
+    """Return the query string that authorizes a request for the given key.
+
+    This is S3's query string request authentication (signature v2). The
+    request must be sent without Content-Type or Content-MD5 headers.
+
+    :param subresource: The sub-resource part of the query string, if
+        any, with its parameters in alphabetical order, e.g.
+        ``partNumber=1&uploadId=abc``. It must be put in the URL too.
+    """
+    cache_key = ('s3', access_key, bucket_name, path, expires, method,
+                 subresource)
+    query = signature_cache.get(cache_key)
+    if query is None:
+        resource = '/%s/%s' % (bucket_name, quote(path))
+        if subresource:
+            resource += '?' + subresource
+        string_to_sign = '%s\n\n\n%d\n%s' % (method, expires, resource)
+        signature = b64encode(hmac.new(secret_key, string_to_sign, sha1).digest())
+        query = 'AWSAccessKeyId=%s&Expires=%d&Signature=%s' % (
+            access_key, expires, quote(signature, safe=''))
+        signature_cache.set(cache_key, query, expires - time.time())
+    return query
+
+def cloudfront_query_auth(resource, expires, key_pair_id, private_key):
+    """Return the query string of a CloudFront signed URL with a canned policy.
+
+    :param resource: For download distributions, the full URL of the file.
+        For streaming distributions, the stream name.
+    :param expires: The expiry time as a unix timestamp.
+    :param key_pair_id: The ID of the CloudFront key pair.
+    :param private_key: The key pair's private key, as a PEM string.
+    :raises StorageError: If the ``rsa`` package isn't installed.
+    """
+    cache_key = ('cf', key_pair_id, resource, expires)
+    query = signature_cache.get(cache_key)
+    if query is None:
+        if rsa is None:
+            raise StorageError('The rsa package must be installed to sign '
+                               'CloudFront URLs.')
+        policy = ('{"Statement":[{"Resource":"%s","Condition":'
+                  '{"DateLessThan":{"AWS:EpochTime":%d}}}]}'
+                  % (resource, expires))
+        key = rsa.PrivateKey.load_pkcs1(private_key)
+        signature = _cloudfront_b64(rsa.sign(policy, key, 'SHA-1'))
+        query = 'Expires=%d&Signature=%s&Key-Pair-Id=%s' % (
+            expires, signature, key_pair_id)
+        signature_cache.set(cache_key, query, expires - time.time())
+    return query
+
+def _cloudfront_b64(data):
+    """Base64 encode using CloudFront's URL safe alphabet."""
+    return b64encode(data).replace('+', '-').replace('=', '_').replace('/', '~')
@@ -0,0 +1,75 @@
+# This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
+
+import errno
+import os
+from thread import get_ident
+
+from pylons import config
+
+__all__ = ['LocalItemStore']
+
+class LocalItemStore(object):
+    """Small per-item values kept on the local filesystem.
+
+    Each value is stored in its own file at
+    ``<cache.dir>/s3/<name>/<image_dir>/<item_id>`` so that reads need no
+    database query and no S3 request. Like the local thumbnail store in
+    ``<cache.dir>/images``, this directory must be shared between servers
+    when MediaCore runs on more than one.
+
+    Items are identified the same way as in :mod:`mediacore.lib.thumbnails`,
+    with an ``(image_dir, item_id)`` tuple.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    @property
+    def root(self):
+        return os.path.join(config['cache.dir'], 's3', self.name)
+
+    def _path(self, image_dir, item_id):
+        return os.path.join(self.root, image_dir, str(item_id))
+
+    def get(self, image_dir, item_id, default=None):
+        """Return the value stored for the item, or the default."""
+        try:
+            f = open(self._path(image_dir, item_id), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return default
+            raise
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def set(self, image_dir, item_id, value='1'):
+        """Store a value for the item, replacing any existing value.
+
+        The value is written to a temporary file and renamed into place
+        so that concurrent readers never see a partial write.
+        """
+        path = self._path(image_dir, item_id)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), get_ident())
+        f = open(tmp_path, 'wb')
+        try:
+            f.write(value)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+    def delete(self, image_dir, item_id):
+        """Remove the value stored for the item, if there is one."""
+        try:
+            os.remove(self._path(image_dir, item_id))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
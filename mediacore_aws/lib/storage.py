@@ -1,21 +1,23 @@
 # This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
 
 import hmac
+import logging
 import os
+import posixpath
 import simplejson
+import time
 
 from base64 import b64encode
 from boto.exception import S3ResponseError
-from boto.s3.connection import S3Connection
 from datetime import datetime, timedelta
 from shutil import copyfileobj
+from urllib import quote
 from urlparse import urlunsplit
 
 from pylons import config
 
 from mediacore.lib.compat import sha1
 from mediacore.lib.i18n import N_
-from mediacore.lib.decorators import memoize
 from mediacore.lib.filetypes import guess_container_format, guess_media_type
 from mediacore.lib.storage import safe_file_name, FileStorageEngine, StorageError
 from mediacore.lib.storage.localfiles import LocalFileStorage
@@ -23,6 +25,54 @@ from mediacore.lib.uri import StorageURI
 from mediacore.lib.util import delete_files, url_for
 
 from mediacore_aws.forms.admin.storage import AmazonS3StorageForm
+from mediacore_aws.lib.connections import get_connection_pool
+from mediacore_aws.lib.diskcache import get_disk_cache
+from mediacore_aws.lib.metrics import instrumented
+from mediacore_aws.lib.multipart import (MAX_COPY_SIZE, MultipartUploader,
+    choose_part_size, copy_in_parts, open_upload)
+from mediacore_aws.lib.retry import get_retry_policy
+from mediacore_aws.lib.signing import (cloudfront_query_auth,
+    quantized_expiry, s3_query_auth)
+from mediacore_aws.lib.util import chunked, hashed_prefix
+
+log = logging.getLogger(__name__)
+
+# The maximum number of keys S3 will delete in one multi-object request
+MULTI_DELETE_LIMIT = 1000
+
+# The choices for the s3_endpoint setting
+S3_ENDPOINTS = ('standard', 'dualstack', 'accelerate', 'accelerate-dualstack')
+
+# Older location constraints, as returned by GET Bucket location
+_legacy_regions = {'': 'us-east-1', 'EU': 'eu-west-1'}
+
+# Regions looked up for engines that don't have one saved, by bucket name
+_discovered_regions = {}
+
+def s3_endpoint_host(region=None, endpoint='standard'):
+    """Return the S3 API host for the given region and kind of endpoint.
+
+    :param region: The bucket's region, or None if it's not known, in
+        which case the global endpoint is used for standard requests.
+    :param endpoint: One of :data:`S3_ENDPOINTS`. Transfer Acceleration
+        endpoints are global, the others are regional.
+    """
+    if endpoint == 'accelerate':
+        return 's3-accelerate.amazonaws.com'
+    if endpoint == 'accelerate-dualstack':
+        return 's3-accelerate.dualstack.amazonaws.com'
+    if endpoint == 'dualstack':
+        return 's3.dualstack.%s.amazonaws.com' % (region or 'us-east-1')
+    if not region or region == 'us-east-1':
+        return 's3.amazonaws.com'
+    return 's3.%s.amazonaws.com' % region
+
+# Signed URLs are valid for between one and two of these periods, in seconds
+DEFAULT_SIGNED_URL_TTL = 3600
+
+# How long the part URLs for a chunked upload are valid, in seconds. A
+# resumed upload gets new URLs.
+DEFAULT_PART_URL_TTL = 6 * 3600
 
 class AmazonS3Storage(FileStorageEngine):
 
@@ -38,6 +88,13 @@ class AmazonS3Storage(FileStorageEngine):
         's3_bucket_dir': '',
         'cf_download_domain': '',
         'cf_streaming_domain': '',
+        'signed_urls': False,
+        'signed_url_ttl': DEFAULT_SIGNED_URL_TTL,
+        'cf_key_pair_id': '',
+        'cf_private_key': '',
+        's3_region': '',
+        's3_endpoint': 'standard',
+        'key_layout': 'flat',
     }
 
     settings_form_class = AmazonS3StorageForm
@@ -47,17 +104,18 @@ class AmazonS3Storage(FileStorageEngine):
     def prepare_for_upload(self, media_file, content_type, filename, filesize):
         if content_type != 'multipart/form-data':
             raise StorageError("Cannot direct upload without using multipart "
-                               "form data and we haven't implemented a file "
-                               "upload pass through.")
+                               "form data. Files uploaded to the server are "
+                               "streamed to S3 by store() instead.")
 
         media_file.storage = self
-        media_file.unique_id = self._get_path(safe_file_name(media_file, filename))
+        media_file.unique_id = self._new_unique_id(media_file, filename)
+        key_name = self._get_path(media_file.unique_id)
 
         access_key = self._data['aws_access_key'].encode('utf-8')
         secret_key = self._data['aws_secret_key'].encode('utf-8')
         bucket_name = self._data['s3_bucket_name'].encode('utf-8')
 
-        acl = 'public-read'
+        acl = self.media_acl
         mimetype = media_file.mimetype
         success_action_status = 201 # Return XML instead of redirecting
         expiration = (datetime.utcnow() + timedelta(hours=4))\
@@ -69,7 +127,7 @@ class AmazonS3Storage(FileStorageEngine):
                 {'bucket': bucket_name},
 
                 # Prevent tampering with our POST data below
-                {'key': media_file.unique_id},
+                {'key': key_name},
                 {'acl': acl},
                 {'success_action_status': str(success_action_status)},
                 {'Content-Type': mimetype},
@@ -88,7 +146,7 @@ class AmazonS3Storage(FileStorageEngine):
 
         post_data = {
             'AWSAccessKeyId': access_key,
-            'key': media_file.unique_id,
+            'key': key_name,
             'acl': acl,
             'success_action_status': success_action_status,
             'Policy': policy,
@@ -102,31 +160,369 @@ class AmazonS3Storage(FileStorageEngine):
             'file_post_var_name': 'file',
         }
 
-    @memoize
+    @instrumented
+    def store(self, media_file, file=None, url=None, meta=None):
+        """Store the given file in S3 and return its unique ID.
+
+        The file is streamed to S3 with :meth:`upload_stream` rather than
+        being written to local disk first.
+
+        :type media_file: :class:`~mediacore.model.media.MediaFile`
+        :param media_file: The associated media file object.
+        :type file: :class:`cgi.FieldStorage` or None
+        :param file: A freshly uploaded file object.
+        :type url: unicode or None
+        :param url: A remote URL string.
+        :type meta: dict
+        :param meta: The metadata returned by :meth:`parse`.
+        :rtype: unicode or None
+        :returns: The unique ID string.
+
+        """
+        file.file.seek(0)
+        return self.upload_stream(media_file, file.file, file.filename)
+
+    @instrumented
+    def upload_stream(self, media_file, source, filename, upload_id=None,
+                      abort_on_failure=True):
+        """Stream a large file into S3 using a multipart upload.
+
+        Parts are read from the source and uploaded in parallel, holding
+        only a few parts in memory at a time, see
+        :class:`mediacore_aws.lib.multipart.MultipartUploader`. The part
+        size and number of upload threads can be set in the config with
+        ``s3.multipart_part_size`` and ``s3.multipart_threads``.
+
+        This method is exclusive to this engine.
+
+        :type media_file: :class:`~mediacore.model.media.MediaFile`
+        :param media_file: The associated media file object. Its
+            ``unique_id`` is set, and the file is stored at the key
+            :meth:`_get_path` gives for it.
+        :param source: A file-like object or an iterable of strings.
+        :type filename: unicode
+        :param filename: The original name of the file.
+        :param upload_id: The ID of an interrupted upload of the same file
+            to resume, as given by :attr:`MultipartUploadError.upload_id`.
+        :type abort_on_failure: bool
+        :param abort_on_failure: If False, a failed upload is left open
+            so that it can be resumed, instead of being aborted.
+        :rtype: unicode
+        :returns: The unique ID string.
+        :raises MultipartUploadError: If the upload fails.
+
+        """
+        if not upload_id or not media_file.unique_id:
+            media_file.unique_id = self._new_unique_id(media_file, filename)
+        uploader = MultipartUploader(
+            self.connect_to_bucket(),
+            self._key_name(media_file),
+            headers={'Content-Type': media_file.mimetype},
+            policy=self.media_acl,
+            part_size=int(config.get('s3.multipart_part_size', 16 * 1024 * 1024)),
+            max_workers=int(config.get('s3.multipart_threads', 4)),
+        )
+        uploader.upload(source, upload_id, abort_on_failure)
+        return media_file.unique_id
+
+    @instrumented
+    def prepare_for_chunked_upload(self, media_file, filename, filesize,
+                                   upload_id=None):
+        """Start a multipart upload for the browser to send parts of.
+
+        Unlike :meth:`prepare_for_upload`, which signs a single POST of the
+        whole file, this starts an S3 multipart upload and returns a
+        presigned URL for each part. The client PUTs each slice of the file
+        to its URL, in parallel if it likes, without a Content-Type header,
+        then calls :meth:`complete_chunked_upload`. The bucket's CORS
+        configuration must allow PUT from the site and expose the ETag
+        header. Clients that can't do this should use the POST upload.
+
+        An interrupted upload is resumed by calling this again with its
+        ``upload_id``. Only the parts that S3 doesn't have in full are
+        returned, with fresh URLs.
+
+        This method is exclusive to this engine.
+
+        :type media_file: :class:`~mediacore.model.media.MediaFile`
+        :param media_file: The associated media file object. Its
+            ``unique_id`` is set, and must be saved before the upload is
+            completed.
+        :type filename: unicode
+        :param filename: The original name of the file.
+        :type filesize: int
+        :param filesize: The size of the file in bytes.
+        :param upload_id: The ID of an earlier upload of this file to resume.
+        :rtype: dict
+        :returns: A dict with the ``upload_id``, the ``part_size`` to slice
+            the file into, the ``parts`` still to upload as a list of dicts
+            with a ``part_number`` and ``url``, and the part numbers that
+            are already ``uploaded``.
+        :raises StorageError: If the upload can't be started or resumed.
+        """
+        bucket = self.connect_to_bucket()
+        uploaded = {}
+        try:
+            if upload_id:
+                mp = open_upload(bucket, self._key_name(media_file),
+                                 upload_id)
+                uploaded = dict((part.part_number, int(part.size))
+                                for part in mp)
+            else:
+                media_file.storage = self
+                media_file.unique_id = self._new_unique_id(media_file,
+                                                           filename)
+                mp = bucket.initiate_multipart_upload(
+                    self._key_name(media_file),
+                    headers={'Content-Type': media_file.mimetype},
+                    policy=self.media_acl)
+        except S3ResponseError, e:
+            raise StorageError('Error - Unable to start the upload to S3: %s'
+                               % e)
+
+        expires = int(time.time()) + int(config.get(
+            's3.chunked_upload_url_ttl', DEFAULT_PART_URL_TTL))
+        part_size, part_sizes = self._chunked_part_sizes(filesize, uploaded)
+        part_count = len(part_sizes)
+        parts = []
+        for part_number, expected in enumerate(part_sizes):
+            part_number += 1
+            if uploaded.get(part_number) == expected:
+                continue
+            parts.append({
+                'part_number': part_number,
+                'url': self._part_url(media_file.unique_id, mp.id,
+                                      part_number, expires),
+            })
+        return {
+            'upload_id': mp.id,
+            'part_size': part_size,
+            'parts': parts,
+            'uploaded': sorted(number for number in uploaded
+                               if number <= part_count),
+        }
+
+    @instrumented
+    def complete_chunked_upload(self, media_file, upload_id, filesize):
+        """Complete a multipart upload started by
+        :meth:`prepare_for_chunked_upload`.
+
+        The parts are listed from S3 rather than trusted from the client,
+        and must be exactly the parts the file was sliced into, so that a
+        truncated upload is never completed.
+
+        This method is exclusive to this engine.
+
+        :type media_file: :class:`~mediacore.model.media.MediaFile`
+        :param media_file: The associated media file object.
+        :param upload_id: The upload's ID.
+        :type filesize: int
+        :param filesize: The size of the file in bytes, as given to
+            :meth:`prepare_for_chunked_upload`.
+        :rtype: unicode
+        :returns: The unique ID string.
+        :raises StorageError: If parts are missing, incomplete or
+            unexpected, or S3 won't complete the
+            upload. The upload is left open so the missing parts can be
+            sent after resuming it.
+        """
+        mp = open_upload(self.connect_to_bucket(),
+                         self._key_name(media_file), upload_id)
+        try:
+            sizes = dict((part.part_number, int(part.size)) for part in mp)
+            part_size, part_sizes = self._chunked_part_sizes(filesize, sizes)
+            missing = [number + 1 for number, expected
+                       in enumerate(part_sizes)
+                       if sizes.get(number + 1) != expected]
+            if missing:
+                raise StorageError('Error - Parts %s of the upload to S3 are '
+                                   'missing or incomplete'
+                                   % ', '.join(map(str, missing)))
+            unexpected = sorted(number for number in sizes
+                                if number > len(part_sizes))
+            if unexpected:
+                raise StorageError('Error - Parts %s of the upload to S3 are '
+                                   'past the end of the file'
+                                   % ', '.join(map(str, unexpected)))
+            mp.complete_upload()
+        except S3ResponseError, e:
+            raise StorageError('Error - Unable to complete the upload to S3: '
+                               '%s' % e)
+        return media_file.unique_id
+
+    def _chunked_part_sizes(self, filesize, uploaded):
+        """Return the part size a chunked upload of the file is sliced
+        with, and the size each of its parts must have.
+
+        A resumed upload keeps being sliced the way it was sliced before,
+        going by the size of its first part.
+
+        This method is exclusive to this engine.
+
+        :param uploaded: A dict of the sizes of the parts S3 already has,
+            by part number.
+        """
+        part_size = choose_part_size(filesize,
+            int(config.get('s3.multipart_part_size', 16 * 1024 * 1024)))
+        if 1 in uploaded and uploaded[1] < filesize:
+            part_size = uploaded[1]
+        part_count = max(1, -(-filesize // part_size))
+        return part_size, [min(part_size, filesize - number * part_size)
+                           for number in xrange(part_count)]
+
+    @instrumented
+    def abort_chunked_upload(self, media_file, upload_id):
+        """Abort a multipart upload, discarding the parts sent so far.
+
+        This method is exclusive to this engine.
+        """
+        mp = open_upload(self.connect_to_bucket(),
+                         self._key_name(media_file), upload_id)
+        try:
+            mp.cancel_upload()
+        except S3ResponseError, e:
+            raise StorageError('Error - Unable to abort the upload to S3: %s'
+                               % e)
+
+    def _part_url(self, unique_id, upload_id, part_number, expires):
+        """Return a presigned URL to PUT one part of a multipart upload.
+
+        This method is exclusive to this engine.
+        """
+        path = self._get_path(unique_id).encode('utf-8')
+        subresource = 'partNumber=%d&uploadId=%s' % (part_number, upload_id)
+        auth = s3_query_auth(
+            self._data['aws_access_key'].encode('utf-8'),
+            self._data['aws_secret_key'].encode('utf-8'),
+            self._data['s3_bucket_name'].encode('utf-8'),
+            path, expires, 'PUT', subresource)
+        return '%s%s?partNumber=%d&uploadId=%s&%s' % (
+            self.bucket_url, quote(path), part_number,
+            quote(upload_id, safe=''), auth)
+
     def connect(self):
-        """Open a boto connection to S3 using our AWS credentials."""
+        """Open a boto connection to S3 using our AWS credentials.
+
+        Connections are shared by all engines with the same credentials
+        and reused for the life of the process, see
+        :class:`mediacore_aws.lib.connections.S3ConnectionPool`.
+        """
         access_key = self._data['aws_access_key'].encode('utf-8')
         secret_key = self._data['aws_secret_key'].encode('utf-8')
         try:
-            return S3Connection(access_key, secret_key)
+            return get_connection_pool().get_connection(access_key, secret_key,
+                                                        self.s3_host)
         except S3ResponseError, e:
             raise StorageError("There was an error connecting to Amazon S3. "
                                "Please make sure that you have entered "
                                "the correct credentials in your settings.")
 
     def connect_to_bucket(self):
-        """Open a boto connection to configured S3 bucket."""
+        """Open a boto connection to configured S3 bucket.
+
+        The bucket isn't validated, so a misconfigured bucket name will
+        only raise an error once it's actually used.
+        """
+        access_key = self._data['aws_access_key'].encode('utf-8')
+        secret_key = self._data['aws_secret_key'].encode('utf-8')
         bucket_name = self._data['s3_bucket_name'].encode('utf-8')
-        conn = self.connect()
         try:
-            return conn.get_bucket(bucket_name)
+            return get_connection_pool().get_bucket(access_key, secret_key,
+                                                    bucket_name, self.s3_host)
         except S3ResponseError, e:
             raise StorageError("Error - Unable to connect to S3 bucket")
 
+    @property
+    def sharded(self):
+        """True if new keys are spread across hashed prefixes.
+
+        With the ``hashed`` key layout each media file is stored under a
+        prefix made from a hash of its file name, e.g.
+        ``<s3_bucket_dir>/3f/<file name>``, and each item's thumbs under a
+        prefix made from a hash of its ID. The prefix is part of the media
+        file's unique ID, and recorded for each item's thumbs, so existing
+        keys keep working until they're moved with
+        ``batch-scripts/migrate-key-layout.py``.
+        """
+        return self._data.get('key_layout') == 'hashed'
+
+    @property
+    def media_acl(self):
+        """The canned ACL for uploaded media files.
+
+        Files are kept private when they're served with signed URLs.
+        """
+        if self._data.get('signed_urls', False):
+            return 'private'
+        return 'public-read'
+
+    def discover_region(self):
+        """Ask S3 which region our bucket is in.
+
+        This method is exclusive to this engine.
+
+        :returns: The region name, e.g. ``eu-west-1``, or None if it
+            couldn't be found out.
+        """
+        access_key = self._data['aws_access_key'].encode('utf-8')
+        secret_key = self._data['aws_secret_key'].encode('utf-8')
+        bucket_name = self._data['s3_bucket_name'].encode('utf-8')
+        try:
+            bucket = get_connection_pool()\
+                .get_bucket(access_key, secret_key, bucket_name)
+            location = get_retry_policy('read').call(bucket.get_location)
+        except S3ResponseError, e:
+            log.warning('Unable to find the region of S3 bucket %s: %s',
+                        bucket_name, e)
+            return None
+        return _legacy_regions.get(location, location)
+
+    @property
+    def region(self):
+        """The bucket's region, or None if it isn't known.
+
+        The region is saved in the engine settings when they're edited.
+        Engines saved before then look it up once per process.
+        """
+        region = self._data.get('s3_region')
+        if region:
+            return region
+        bucket_name = self._data['s3_bucket_name']
+        if bucket_name not in _discovered_regions:
+            _discovered_regions[bucket_name] = self.discover_region()
+        return _discovered_regions[bucket_name]
+
+    @property
+    def s3_host(self):
+        """The host to make S3 requests to, see :func:`s3_endpoint_host`."""
+        host = s3_endpoint_host(self.region,
+                                self._data.get('s3_endpoint') or 'standard')
+        # Settings are unicode but boto expects a byte string host
+        return host.encode('utf-8')
+
     @property
     def bucket_url(self):
-        return 'https://%s.s3.amazonaws.com/' % self._data['s3_bucket_name']
+        """The bucket's URL on :attr:`s3_host`, for uploads."""
+        return 'https://%s.%s/' % (self._data['s3_bucket_name'], self.s3_host)
+
+    @property
+    def download_url(self):
+        """The bucket's URL for downloads and thumbnails.
 
+        Transfer Acceleration only pays off for uploads and is billed per
+        byte, so downloads always use the regional endpoint, dual-stack if
+        the engine is. Bucket names with dots don't match the wildcard SSL
+        certificate as a subdomain, so they're addressed by path.
+        """
+        endpoint = self._data.get('s3_endpoint') or 'standard'
+        host = s3_endpoint_host(self.region, endpoint.endswith('dualstack')
+                                             and 'dualstack' or 'standard')
+        bucket_name = self._data['s3_bucket_name']
+        if '.' in bucket_name:
+            return 'https://%s/%s/' % (host, bucket_name)
+        return 'https://%s.%s/' % (bucket_name, host)
+
+    @instrumented
     def delete(self, media_file):
         """Delete the stored file represented by the given unique ID.
 
@@ -136,17 +532,113 @@ class AmazonS3Storage(FileStorageEngine):
         :returns: True if successful, False if an error occurred.
 
         """
-        file_path = self._get_path(media_file.unique_id)
+        self.delete_paths([self._get_path(media_file.unique_id)])
+        return True
+
+    @instrumented
+    def delete_many(self, media_files):
+        """Delete the stored files for all of the given media files.
+
+        All of the files are deleted with as few requests as possible,
+        see :meth:`delete_paths`.
+
+        :type media_files: list
+        :param media_files: :class:`~mediacore.model.media.MediaFile`
+            instances that are stored with this engine.
+        :raises StorageError: If any of the files couldn't be deleted.
+
+        """
+        self.delete_paths(self._get_path(media_file.unique_id)
+                          for media_file in media_files)
+
+    @instrumented
+    def delete_paths(self, paths):
+        """Delete the given keys from the bucket.
+
+        This uses S3's multi-object delete, which removes up to 1000 keys
+        per request and reports an error for each key it couldn't delete.
+        Keys that don't exist are considered to have been deleted.
+
+        This method is exclusive to this engine.
+
+        :type paths: iterable
+        :param paths: Key names within the bucket.
+        :rtype: list
+        :returns: The key names that were deleted.
+        :raises StorageError: If any of the keys couldn't be deleted. The
+            rest of the keys are still deleted before this is raised.
+
+        """
         bucket = self.connect_to_bucket()
+        deleted = []
+        errors = []
+        for chunk in chunked(paths, MULTI_DELETE_LIMIT):
+            try:
+                result = get_retry_policy('write').call(
+                    bucket.delete_keys, chunk, quiet=True)
+            except S3ResponseError, e:
+                errors.extend('%s (%s)' % (path, e.error_code)
+                              for path in chunk)
+                continue
+            failed = set(error.key for error in result.errors)
+            errors.extend('%s (%s)' % (error.key, error.code)
+                          for error in result.errors)
+            deleted.extend(path for path in chunk if path not in failed)
+        if errors:
+            raise StorageError("Error - Failed to delete %d files from S3: %s"
+                               % (len(errors), ', '.join(errors[:10])))
+        return deleted
+
+    def layout_unique_id(self, unique_id):
+        """Return the unique ID the file would have in the current key
+        layout.
+
+        The hashed prefix is added to, or removed from, the directory the
+        file is in. Nothing else about the unique ID changes. Unique IDs
+        are relative to ``s3_bucket_dir``, so it's never mistaken for a
+        prefix.
+
+        This method is exclusive to this engine.
+        """
+        dirname, name = posixpath.split(unique_id)
+        prefix = hashed_prefix(name)
+        if posixpath.basename(dirname) == prefix:
+            dirname = posixpath.dirname(dirname)
+        if self.sharded:
+            dirname = posixpath.join(dirname, prefix)
+        return posixpath.join(dirname, name)
+
+    @instrumented
+    def copy_path(self, src_path, dst_path, policy=None):
+        """Copy a key within the bucket, on the S3 side.
+
+        The content type, cache control and user metadata are kept.
+        Objects too large to copy in one request are copied in parts.
 
-        # TODO: Find out if there is a way that avoids an extra API call
-        # as Boto doesn't appear to return a value from a delete_key()
-        if bucket.get_key(file_path):
-            bucket.delete_key(file_path)
-            if bucket.get_key(file_path):
-                raise StorageError("Error - Failed to delete media from S3")
+        This method is exclusive to this engine.
+
+        :param policy: The canned ACL for the copy. Defaults to
+            :attr:`media_acl`.
+        :rtype: bool
+        :returns: False if the source doesn't exist.
+        :raises StorageError: If the copy fails.
+        """
+        policy = policy or self.media_acl
+        bucket = self.connect_to_bucket()
+        try:
+            key = get_retry_policy('read').call(bucket.get_key, src_path)
+            if key is None:
+                return False
+            if int(key.size) > MAX_COPY_SIZE:
+                copy_in_parts(bucket, key, dst_path, policy,
+                    max_workers=int(config.get('s3.multipart_threads', 4)))
             else:
-                return True
+                get_retry_policy('write').call(bucket.copy_key, dst_path,
+                    bucket.name, src_path, headers={'x-amz-acl': policy})
+        except S3ResponseError, e:
+            raise StorageError('Failed to copy %s to %s in S3: %s'
+                               % (src_path, dst_path, e))
+        return True
 
     def get_uris(self, media_file):
         """Return a list of URIs from which the stored file can be accessed.
@@ -161,23 +653,100 @@ class AmazonS3Storage(FileStorageEngine):
 
         s3_bucket_name = self._data['s3_bucket_name']
         s3_bucket_dir = self._data['s3_bucket_dir']
-        s3_bucket_url = 'https://%s.s3.amazonaws.com/' % s3_bucket_name
+        s3_bucket_url = self.download_url
         cf_download_domain = self._data['cf_download_domain']
         cf_streaming_domain = self._data['cf_streaming_domain']
         file_path = self._get_path(media_file.unique_id)
 
+        signed = self._data.get('signed_urls', False)
+        if signed:
+            expires = quantized_expiry(int(self._data.get('signed_url_ttl')
+                                           or DEFAULT_SIGNED_URL_TTL))
+
         if cf_download_domain:
             cf_download_url = 'http://%s' % cf_download_domain
-            uris.append(StorageURI(media_file, 'http', file_path, cf_download_url))
+            file_uri = file_path
+            if signed:
+                file_uri += '?' + self._cf_query_auth(
+                    '%s/%s' % (cf_download_url, file_path), expires)
+            uris.append(StorageURI(media_file, 'http', file_uri, cf_download_url))
         else:
-            uris.append(StorageURI(media_file, 'http', file_path, s3_bucket_url))
+            file_uri = file_path
+            if signed:
+                file_uri += '?' + s3_query_auth(
+                    self._data['aws_access_key'].encode('utf-8'),
+                    self._data['aws_secret_key'].encode('utf-8'),
+                    s3_bucket_name.encode('utf-8'),
+                    file_path.encode('utf-8'),
+                    expires)
+            uris.append(StorageURI(media_file, 'http', file_uri, s3_bucket_url))
 
         if cf_streaming_domain:
             cf_streaming_url = 'http://%s/cfx/st' % cf_streaming_domain
-            uris.append(StorageURI(media_file, 'rtmp', file_path, cf_streaming_url))
+            file_uri = file_path
+            if signed:
+                file_uri += '?' + self._cf_query_auth(file_path, expires)
+            uris.append(StorageURI(media_file, 'rtmp', file_uri, cf_streaming_url))
 
         return uris
 
+    @instrumented
+    def get_local_path(self, media_file):
+        """Return the path of a local copy of the stored file.
+
+        The copy is kept in a size-capped cache under ``cache.dir``, see
+        :class:`mediacore_aws.lib.diskcache.S3DiskCache`, and is checked
+        against the stored file's ETag each time. The path stays valid for
+        at least ``s3.local_cache_grace`` seconds.
+
+        This method is exclusive to this engine.
+
+        :type media_file: :class:`~mediacore.model.media.MediaFile`
+        :param media_file: The associated media file object.
+        :rtype: str
+        :raises StorageError: If the file can't be downloaded.
+        """
+        return get_disk_cache().get_path(self.connect_to_bucket(),
+                                         self._get_path(media_file.unique_id))
+
+    def open_local(self, media_file):
+        """Return an open file object for a local copy of the stored file.
+
+        See :meth:`get_local_path`. The file stays readable even if it is
+        evicted from the cache while it's open.
+
+        This method is exclusive to this engine.
+        """
+        return open(self.get_local_path(media_file), 'rb')
+
+    def _cf_query_auth(self, resource, expires):
+        """Return the query string that signs a CloudFront URL.
+
+        This method is exclusive to this engine.
+        """
+        return cloudfront_query_auth(
+            resource.encode('utf-8'),
+            expires,
+            self._data.get('cf_key_pair_id', '').encode('utf-8'),
+            self._data.get('cf_private_key', '').encode('utf-8'))
+
+    def _new_unique_id(self, media_file, filename):
+        """Return the unique ID for a new file.
+
+        Like every unique ID it's relative to ``s3_bucket_dir``; the file
+        is stored at the key :meth:`_get_path` returns for it.
+
+        This method is exclusive to this engine.
+        """
+        return self.layout_unique_id(safe_file_name(media_file, filename))
+
+    def _key_name(self, media_file):
+        """Return the key the media file is stored at, as a byte string.
+
+        This method is exclusive to this engine.
+        """
+        return self._get_path(media_file.unique_id).encode('utf-8')
+
     def _get_path(self, unique_id):
         """Return the local file path for the given unique ID.
 
@@ -0,0 +1,154 @@
+# This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
+
+from cStringIO import StringIO
+from hashlib import sha1
+from PIL import Image
+
+from mediacore.lib.storage import StorageError
+from mediacore.lib.thumbnails import resize_thumb
+
+__all__ = [
+    'THUMB_FORMATS',
+    'encode_image',
+    'format_supported',
+    'prepare_source',
+    'render_thumbs',
+    'render_thumbs_from_string',
+    'thumb_content_hash',
+]
+
+# The formats thumbs can be rendered in, by file extension, with their
+# PIL format names and content types.
+THUMB_FORMATS = {
+    'jpg': ('JPEG', 'image/jpeg'),
+    'webp': ('WEBP', 'image/webp'),
+    'avif': ('AVIF', 'image/avif'),
+}
+
+def format_supported(ext):
+    """Return True if the installed PIL can encode the given format.
+
+    WebP and AVIF support depend on how PIL was built and which plugins
+    are installed.
+    """
+    if ext not in THUMB_FORMATS:
+        return False
+    Image.init()
+    return THUMB_FORMATS[ext][0] in Image.SAVE
+
+def thumb_content_hash(data, sizes):
+    """Return a short hash that identifies thumbs made from the image.
+
+    The thumbs only change when the original image or the sizes they're
+    rendered at do, so those are what's hashed. This is much cheaper than
+    hashing every thumb after it's rendered, and it's known before any of
+    them are uploaded.
+
+    :param data: The original image file's contents.
+    :param sizes: A dict of size names and (width, height) tuples.
+    """
+    digest = sha1(data)
+    digest.update(repr(sorted(sizes.iteritems())))
+    return digest.hexdigest()[:12]
+
+def encode_image(img, ext='jpg'):
+    """Return the given PIL image encoded in the format for ``ext``."""
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    buf = StringIO()
+    img.save(buf, THUMB_FORMATS[ext][0])
+    return buf.getvalue()
+
+def _fill_scale(src_size, dst_size):
+    """Return the scale at which the source covers the destination size.
+
+    This is the scale that :func:`resize_thumb` effectively resizes at
+    once it has cropped the source to the destination's aspect ratio.
+    """
+    return max(float(dst_size[0]) / src_size[0],
+               float(dst_size[1]) / src_size[1])
+
+def prepare_source(img, sizes, max_pixels=None):
+    """Decode the image at the smallest scale that serves all sizes.
+
+    JPEGs are decoded in draft mode, which lets the decoder scale the
+    image down by up to 8x as it goes, so the full resolution bitmap is
+    never held in memory. Whatever is left over is resized down to no
+    more than twice what the largest thumb needs. The image is converted
+    to RGB here, once, rather than for each size.
+
+    :param img: An opened but not yet loaded image.
+    :type img: :class:`PIL.Image.Image`
+    :param sizes: An iterable of (width, height) tuples.
+    :param max_pixels: If given, refuse to decode images that would still
+        be larger than this many pixels after draft mode scaling.
+    :returns: The decoded RGB image.
+    :raises StorageError: If the image is too large to decode.
+    """
+    scale = min(1.0, max(_fill_scale(img.size, xy) for xy in sizes))
+    needed = (max(1, int(img.size[0] * scale + 0.5)),
+              max(1, int(img.size[1] * scale + 0.5)))
+    img.draft('RGB', needed)
+    if max_pixels and img.size[0] * img.size[1] > max_pixels:
+        raise StorageError('The image is too large to make thumbs from: '
+                           '%dx%d' % img.size)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    # Resampling twice softens the result slightly, so only do so when
+    # it saves a lot of work for the sizes that follow.
+    if img.size[0] > needed[0] * 2:
+        img = img.resize((needed[0] * 2, needed[1] * 2), Image.ANTIALIAS)
+    return img
+
+def _same_ratio(a, b):
+    """Return True if two sizes have the same aspect ratio, give or take
+    a pixel of rounding."""
+    return abs(a[0] * b[1] - a[1] * b[0]) <= max(a[0], a[1], b[0], b[1])
+
+def render_thumbs(img, sizes, max_pixels=None, formats=('jpg',)):
+    """Resize the image to each of the given sizes and encode them.
+
+    This is a generator so that callers can start uploading each thumb
+    as soon as it's ready, and so that only one encoded thumb needs to
+    be held in memory by us at a time.
+
+    The image is decoded with :func:`prepare_source` and the sizes are
+    rendered largest first. Each one is resized from the previous thumb
+    when they have the same aspect ratio, so the large source is only
+    resampled for the first size of each shape.
+
+    :param img: The original image.
+    :type img: :class:`PIL.Image.Image`
+    :param sizes: A dict of size names and (width, height) tuples, as
+        found in ``config['thumb_sizes'][image_dir]``.
+    :param max_pixels: See :func:`prepare_source`.
+    :param formats: The extensions of the formats to encode each size
+        in, see :data:`THUMB_FORMATS`.
+    :returns: Yields ``(size_name, ext, data)`` tuples.
+    """
+    if not sizes:
+        return
+    ordered = sorted(sizes.iteritems(),
+                     key=lambda (size, xy): xy[0] * xy[1], reverse=True)
+    source = prepare_source(img, [xy for size, xy in ordered], max_pixels)
+    previous = None
+    for size, xy in ordered:
+        if previous is not None and _same_ratio(previous.size, xy) \
+                and previous.size[0] >= xy[0] and previous.size[1] >= xy[1]:
+            thumb = resize_thumb(previous, xy)
+        else:
+            thumb = resize_thumb(source, xy)
+        for ext in formats:
+            yield size, ext, encode_image(thumb, ext)
+        previous = thumb
+
+def render_thumbs_from_string(data, sizes, max_pixels=None, formats=('jpg',)):
+    """Decode the image data and render all of the given sizes.
+
+    This is a plain function of picklable arguments so that it can be
+    run in a :mod:`multiprocessing` pool.
+
+    :returns: A list of ``(size_name, ext, data)`` tuples.
+    """
+    return list(render_thumbs(Image.open(StringIO(data)), sizes, max_pixels,
+                              formats))
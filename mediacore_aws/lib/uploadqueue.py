@@ -0,0 +1,215 @@
+# This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
+
+import errno
+import logging
+import os
+import time
+from thread import get_ident
+from threading import Lock, Thread
+
+import simplejson
+from pylons import config
+
+__all__ = ['UploadQueue']
+
+log = logging.getLogger(__name__)
+
+class UploadQueue(object):
+    """A durable queue of jobs, processed by a background thread.
+
+    Each job is a JSON file under ``<cache.dir>/s3/<name>/``, so jobs
+    survive restarts and can be shared by every process that uses the
+    same cache dir. A job is claimed by renaming it from ``pending/`` to
+    ``working/``, which is atomic, so each job is only run by one worker
+    at a time. Failed jobs are retried with exponential backoff and moved
+    to ``failed/`` after ``max_attempts``.
+
+    Putting a job with the same ID as a pending job replaces it.
+
+    :param handler: Called with the job's payload dict. Any exception
+        causes the job to be retried.
+    """
+
+    def __init__(self, name, handler, max_attempts=10, retry_delay=15,
+                 poll_interval=5, stale_after=600):
+        self.name = name
+        self.handler = handler
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self._thread = None
+        self._lock = Lock()
+
+    @property
+    def root(self):
+        return os.path.join(config['cache.dir'], 's3', self.name)
+
+    def _dir(self, state):
+        path = os.path.join(self.root, state)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return path
+
+    def put(self, job_id, payload):
+        """Add a job to the queue, replacing any pending job with this ID."""
+        payload = dict(payload, _attempts=0, _retry_at=0)
+        self._write(os.path.join(self._dir('pending'), job_id + '.json'),
+                    payload)
+        self.start()
+
+    def cancel(self, job_id):
+        """Remove the pending job with this ID.
+
+        A job that a worker has already claimed isn't affected.
+
+        :returns: The cancelled job's payload, or None if there wasn't one.
+        """
+        path = os.path.join(self._dir('pending'), job_id + '.json')
+        payload = self._read(path)
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return payload
+
+    def start(self):
+        """Start this process's worker thread, if it isn't running."""
+        if self._thread is not None and self._thread.isAlive():
+            return
+        self._lock.acquire()
+        try:
+            if self._thread is None or not self._thread.isAlive():
+                self._thread = Thread(target=self._run,
+                                      name='UploadQueue-%s' % self.name)
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            try:
+                self.process()
+            except Exception:
+                log.exception('Error processing the %s queue', self.name)
+            time.sleep(self.poll_interval)
+
+    def process(self, limit=None):
+        """Run the jobs that are due, returning the number that succeeded.
+
+        This is called by the worker thread, but can also be called by a
+        script to drain the queue.
+        """
+        self._requeue_stale()
+        pending_dir = self._dir('pending')
+        working_dir = self._dir('working')
+        succeeded = 0
+        now = time.time()
+        for filename in sorted(os.listdir(pending_dir)):
+            if not filename.endswith('.json'):
+                continue
+            if limit is not None and succeeded >= limit:
+                break
+            pending_path = os.path.join(pending_dir, filename)
+            payload = self._read(pending_path)
+            if payload is None or payload['_retry_at'] > now:
+                continue
+            working_path = os.path.join(working_dir, '%s.%d.%d' % (
+                filename, os.getpid(), get_ident()))
+            try:
+                os.rename(pending_path, working_path)
+            except OSError, e:
+                if e.errno == errno.ENOENT:
+                    continue # Claimed by another worker
+                raise
+            # The rename keeps the time the job was queued at, which would
+            # make a long queued job look stale to other workers
+            os.utime(working_path, None)
+            if self._run_job(filename, payload, working_path):
+                succeeded += 1
+        return succeeded
+
+    def _run_job(self, filename, payload, working_path):
+        try:
+            self.handler(payload)
+        except Exception:
+            log.exception('Job %s in the %s queue failed', filename, self.name)
+            attempts = payload['_attempts'] + 1
+            try:
+                if attempts >= self.max_attempts:
+                    os.rename(working_path,
+                              os.path.join(self._dir('failed'), filename))
+                    return False
+                payload['_attempts'] = attempts
+                payload['_retry_at'] = time.time() \
+                    + self.retry_delay * 2 ** (attempts - 1)
+                pending_path = os.path.join(self._dir('pending'), filename)
+                if os.path.exists(pending_path):
+                    # A newer job replaced this one while it was running
+                    self._remove(working_path)
+                elif os.path.exists(working_path):
+                    self._write(working_path, payload)
+                    os.rename(working_path, pending_path)
+            except OSError, e:
+                # Another worker took the job back while it was running
+                if e.errno != errno.ENOENT:
+                    raise
+            return False
+        self._remove(working_path)
+        return True
+
+    def _remove(self, path):
+        """Remove a claimed job, unless another worker already has."""
+        try:
+            os.remove(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _requeue_stale(self):
+        """Return jobs claimed by workers that died to the pending dir."""
+        working_dir = self._dir('working')
+        pending_dir = self._dir('pending')
+        cutoff = time.time() - self.stale_after
+        for filename in os.listdir(working_dir):
+            working_path = os.path.join(working_dir, filename)
+            try:
+                if os.path.getmtime(working_path) > cutoff:
+                    continue
+                pending_path = os.path.join(pending_dir,
+                                            filename.split('.json')[0] + '.json')
+                if os.path.exists(pending_path):
+                    os.remove(working_path)
+                else:
+                    os.rename(working_path, pending_path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def _read(self, path):
+        try:
+            f = open(path)
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return simplejson.load(f)
+        finally:
+            f.close()
+
+    def _write(self, path, payload):
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), get_ident())
+        f = open(tmp_path, 'w')
+        try:
+            simplejson.dump(payload, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
@@ -0,0 +1,33 @@
+# This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
+
+from hashlib import md5
+from itertools import islice
+
+__all__ = ['chunked', 'hashed_prefix']
+
+# The number of hex digits in a hashed key prefix, giving 256 prefixes
+HASHED_PREFIX_LENGTH = 2
+
+def chunked(iterable, size):
+    """Yield lists of up to ``size`` items from the given iterable.
+
+    Only one chunk is held in memory at a time, so this is safe to use
+    with very long generators.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def hashed_prefix(name):
+    """Return the hashed prefix to store the key with the given name under.
+
+    S3 scales its request rate per key prefix, so spreading keys across
+    these prefixes, rather than sharing one, raises the request rate the
+    bucket can sustain.
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return md5(name).hexdigest()[:HASHED_PREFIX_LENGTH]
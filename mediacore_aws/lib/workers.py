@@ -0,0 +1,88 @@
+# This file is a part of MediaCore-AWS, Copyright 2011 Simple Station Inc.
+
+import logging
+from Queue import Queue
+from threading import Lock, Thread
+
+from mediacore.lib.storage import StorageError
+
+from mediacore_aws.lib.metrics import metrics
+
+__all__ = ['ParallelError', 'ThreadPool']
+
+log = logging.getLogger(__name__)
+
+class ParallelError(StorageError):
+    """Raised once all tasks are done if any of them failed.
+
+    :attr failures: A list of ``(args, exception)`` tuples, one for each
+        task that raised.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        msg = '%d of the parallel S3 operations failed: %s' % (
+            len(failures), '; '.join(str(e) for args, e in failures[:5]))
+        StorageError.__init__(self, msg)
+
+
+class ThreadPool(object):
+    """A small, bounded pool of worker threads.
+
+    Tasks are run in the order they're submitted. Worker threads are
+    started lazily, up to ``max_workers``. If ``max_pending`` is given,
+    :meth:`submit` blocks while that many tasks are waiting to run, which
+    bounds the memory held by queued task arguments.
+
+    Exceptions raised by tasks are collected and re-raised together as a
+    :class:`ParallelError` by :meth:`join`. S3 requests made by tasks are
+    attributed to the hook that submitted them, see
+    :class:`mediacore_aws.lib.metrics.S3Metrics`.
+    """
+
+    def __init__(self, max_workers=4, max_pending=0):
+        self.max_workers = max(1, max_workers)
+        self._queue = Queue(max_pending)
+        self._threads = []
+        self._lock = Lock()
+        self.failures = []
+
+    def submit(self, func, *args):
+        """Queue ``func(*args)`` to be called by a worker thread."""
+        if len(self._threads) < self.max_workers:
+            thread = Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+        self._queue.put((func, args, metrics.get_context()))
+
+    def join(self):
+        """Wait for all submitted tasks to finish.
+
+        :raises ParallelError: If any of the tasks raised an exception.
+        """
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.failures:
+            failures, self.failures = self.failures, []
+            raise ParallelError(failures)
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            func, args, context = task
+            metrics.set_context(context)
+            try:
+                func(*args)
+            except Exception, e:
+                log.exception('Parallel task %s failed',
+                              getattr(func, '__name__', func))
+                self._lock.acquire()
+                try:
+                    self.failures.append((args, e))
+                finally:
+                    self._lock.release()
@@ -11,8 +11,14 @@ setup(
     description = 'Amazon Web Services integration for MediaCore.',
     install_requires = [
         'MediaCore >= 0.9.0b3',
-        'boto >= 2.0b3',
+        # Multi-object delete, ranged part copies and multipart upload
+        # ACLs all need a boto of at least this version
+        'boto >= 2.9.0',
     ],
+    extras_require = {
+        # Only needed to sign CloudFront URLs
+        'signed_urls': ['rsa'],
+    },
     entry_points = {
         'mediacore.plugin': ['aws = mediacore_aws'],
     },